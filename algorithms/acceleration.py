@@ -0,0 +1,120 @@
+import numpy as np
+
+# IMPLEMENTATION OF SAFEGUARDED ANDERSON AND SUCCESSIVE OVER-RELAXATION STEPS FOR THE FIXED-POINT DRIVERS
+
+
+class Accelerator:
+    """
+    Accelerates a fixed-point iteration x <- T(x) from the pairs (x, T(x)) of its iterates.
+
+    method='anderson' mixes the last memory updates (Anderson type II: the combination of the T(x_i) whose
+    residuals T(x_i) - x_i cancel best in the least squares sense), method='sor' over-relaxes the update,
+    x + relaxation * (T(x) - x), and method=None takes the plain update T(x) and only counts iterations.
+
+    Safeguard: an accelerated point must have a smaller residual max|T(x) - x| than the point it was computed from.
+    Otherwise it is rejected, the plain update T(x) of that earlier point is taken instead and the Anderson memory is
+    cleared. The driver keeps its stopping rule: the residual of the current point below eps_convergence.
+
+    Parameters:
+    method (str, optional): 'anderson', 'sor' or None. Defaults to 'anderson'.
+    memory (int, optional): Number of past updates mixed by Anderson. Defaults to 5.
+    relaxation (float, optional): The SOR factor, in (1, 2) to over-relax. Defaults to 1.5.
+    regularization (float, optional): Tikhonov factor of the Anderson least squares, relative to its scale.
+        Defaults to 1e-10.
+    """
+    METHODS = ('anderson', 'sor', None)
+
+    def __init__(self, method='anderson', memory=5, relaxation=1.5, regularization=1e-10):
+        if method not in self.METHODS:
+            raise ValueError("Unknown acceleration '%s', expected one of %s" % (method, self.METHODS))
+        self.method = method
+        self.memory = memory
+        self.relaxation = relaxation
+        self.regularization = regularization
+        self.iterations = 0
+        self.accepted = 0
+        self.rejected = 0
+        self._points, self._updates = [], []
+        self._fallback, self._residual = None, np.inf
+
+    def step(self, x, Tx, residual):
+        """
+        The next iterate after the update Tx of x.
+
+        Parameters:
+        x (np.array): The current iterate.
+        Tx (np.array): Its plain update, same shape as x.
+        residual (float): max|Tx - x|.
+
+        Returns:
+        np.array: The next iterate, a new array.
+        """
+        self.iterations += 1
+        if self.method is None:
+            return np.array(Tx, dtype=float)
+
+        if self._fallback is not None and residual >= self._residual:
+            next_x = self._fallback
+            self._points, self._updates = [], []
+            self._fallback, self._residual = None, np.inf
+            self.rejected += 1
+            return next_x
+
+        self._points = (self._points + [np.array(x, dtype=float).ravel()])[-(self.memory + 1):]
+        self._updates = (self._updates + [np.array(Tx, dtype=float).ravel()])[-(self.memory + 1):]
+        if self.method == 'sor':
+            candidate = self._points[-1] + self.relaxation * (self._updates[-1] - self._points[-1])
+        elif len(self._points) > 1:
+            candidate = self._anderson()
+        else:
+            return np.array(Tx, dtype=float)
+
+        self._fallback, self._residual = np.array(Tx, dtype=float), residual
+        self.accepted += 1
+        return candidate.reshape(np.shape(Tx))
+
+    def _anderson(self):
+        G = np.array(self._updates).T
+        F = G - np.array(self._points).T
+        dF, dG = np.diff(F, axis=1), np.diff(G, axis=1)
+        normal = dF.T @ dF
+        normal += self.regularization * max(np.trace(normal), 1e-300) * np.eye(len(normal))
+        gamma = np.linalg.solve(normal, dF.T @ F[:, -1])
+        return G[:, -1] - dG @ gamma
+
+    def report(self):
+        if self.method is None:
+            return 'no acceleration: %d iterations' % self.iterations
+        return '%s acceleration: %d iterations, %d accelerated steps, %d rejected by the safeguard' % (
+            self.method, self.iterations, self.accepted, self.rejected)
+
+
+def make_accelerator(acceleration, **options):
+    """ An Accelerator from a method name (see Accelerator.METHODS), or the given instance itself. """
+    if isinstance(acceleration, Accelerator):
+        return acceleration
+    return Accelerator(acceleration, **options)
+
+
+def compare_acceleration(driver, world, methods=(None, 'anderson', 'sor'), **kwargs):
+    """
+    Runs a driver once per acceleration method and prints the number of iterations of each run.
+
+    Parameters:
+    driver (callable): A driver accepting an 'acceleration' argument, e.g. cvar_value_iteration or value_iteration.
+    world: The environment, or its compiled TransitionTensor.
+    methods (tuple, optional): The methods to compare. Defaults to (None, 'anderson', 'sor').
+    kwargs: Passed on to the driver.
+
+    Returns:
+    dict: Method to (iterations, result of the driver).
+    """
+    runs = {}
+    for method in methods:
+        accelerator = Accelerator(method)
+        result = driver(world, acceleration=accelerator, **kwargs)
+        runs[method] = (accelerator.iterations, result)
+
+    for method, (iterations, _) in runs.items():
+        print('{:<10} {:>6} iterations'.format(str(method), iterations))
+    return runs
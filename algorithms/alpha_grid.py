@@ -0,0 +1,44 @@
+import numpy as np
+
+# IMPLEMENTATION OF THE ALPHA GRID HELPERS: INTERPOLATION BETWEEN GRIDS AND CANDIDATE ATOMS FOR REFINEMENT
+
+
+def interpolate_values(V, alphas, new_alphas):
+    """
+    Moves a CVaR value function to another alpha grid by linear interpolation of alpha * V(alpha), the same
+    interpolation the backups use between atoms.
+
+    Parameters:
+    V (np.array): The value function on alphas, shape (Ny, Ns).
+    alphas (np.array): The sorted alpha atoms of V, starting at 0.
+    new_alphas (np.array): The sorted alpha atoms to interpolate at, within [alphas[0], alphas[-1]].
+
+    Returns:
+    np.array: The value function on new_alphas, shape (len(new_alphas), Ns).
+    """
+    av = alphas[:, None] * V
+    idx = np.clip(np.searchsorted(alphas, new_alphas, side='right') - 1, 0, len(alphas) - 2)
+    weight = ((new_alphas - alphas[idx]) / (alphas[idx + 1] - alphas[idx]))[:, None]
+    av_new = (1 - weight) * av[idx] + weight * av[idx + 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        V_new = av_new / new_alphas[:, None]
+    # at alpha = 0 the product carries no information, take the atom itself
+    return np.where(new_alphas[:, None] == 0, V[np.searchsorted(alphas, 0)], V_new)
+
+
+def candidate_atoms(alphas, min_gap=1e-4):
+    """
+    One candidate atom per interval of the grid: the geometric midpoint, or the arithmetic one for the interval
+    starting at alpha = 0. Intervals narrower than min_gap get no candidate.
+
+    Parameters:
+    alphas (np.array): The sorted alpha atoms.
+    min_gap (float, optional): The narrowest interval worth splitting. Defaults to 1e-4.
+
+    Returns:
+    np.array: The candidate atoms, sorted.
+    """
+    low, high = alphas[:-1], alphas[1:]
+    with np.errstate(invalid='ignore'):
+        midpoints = np.where(low > 0, np.sqrt(low * high), (low + high) / 2)
+    return midpoints[high - low > min_gap]
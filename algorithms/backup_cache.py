@@ -0,0 +1,73 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+# IMPLEMENTATION OF A BOUNDED CACHE OF CVAR BACKUP BLOCKS KEYED ON THEIR QUANTIZED INPUTS
+
+
+class BackupCache:
+    """
+    Bounded cache of the (action, alpha) blocks of the CVaR backup.
+
+    The LP of a block only depends on the transition probabilities and rewards of the action, the successor columns
+    of the frozen value function, the alpha atoms and the discount. These inputs are quantized to multiples of
+    tolerance, their successors put in a canonical order (the backup does not depend on it) and hashed, so states
+    with the same local picture, and states whose successors did not move since the previous sweep, share their
+    solutions. A reused block may differ from a fresh solve by about the tolerance times the size of the inputs.
+
+    Parameters:
+    size (int, optional): Largest number of stored blocks. Defaults to 100000.
+    policy (str, optional): Eviction policy once full, 'lru' (least recently used) or 'fifo' (oldest stored).
+        Defaults to 'lru'.
+    tolerance (float, optional): Quantization step of the inputs, 0 to only reuse bit-identical inputs.
+        Defaults to 1e-12.
+    """
+
+    POLICIES = ('lru', 'fifo')
+
+    def __init__(self, size=100000, policy='lru', tolerance=1e-12):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown eviction policy '%s', expected one of %s" % (policy, self.POLICIES))
+        self.size = int(size)
+        self.policy = policy
+        self.tolerance = tolerance
+        self.blocks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def quantize(self, x):
+        x = np.asarray(x, dtype=float)
+        return np.round(x / self.tolerance).astype(np.int64) if self.tolerance > 0 else x
+
+    def action_key(self, probs, rewards, successor_V, alpha_set, discount):
+        """ The hash of the inputs of an action's blocks; a block is keyed by it and its alpha index. """
+        columns = np.vstack((self.quantize(successor_V), self.quantize(rewards), self.quantize(probs)))
+        columns = columns[:, np.lexsort(columns)]
+        digest = hashlib.blake2b(digest_size=16)
+        for part in (columns, np.asarray(alpha_set, dtype=float), np.array([discount], dtype=float)):
+            digest.update(np.ascontiguousarray(part).tobytes())
+        return digest.digest()
+
+    def get(self, key):
+        """ The stored value of key, None on a miss. """
+        value = self.blocks.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.policy == 'lru':
+            self.blocks.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.blocks[key] = value
+        if len(self.blocks) > self.size:
+            self.blocks.popitem(last=False)
+            self.evictions += 1
+
+    def report(self):
+        lookups = self.hits + self.misses
+        return 'cache hits: %d of %d blocks (%.1f%%), stored: %d, evictions: %d' % (
+            self.hits, lookups, 100. * self.hits / max(lookups, 1), len(self.blocks), self.evictions)
@@ -0,0 +1,444 @@
+import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
+from pulp import CPLEX_PY, PULP_CBC_CMD
+from scipy.sparse import vstack
+from tqdm import tqdm
+
+from algorithms.backup_cache import BackupCache
+from algorithms.cvar_backup import SolverError, assemble_batch_lp, cvar_action_backup, cvar_closed_form_backup, \
+    cvar_highs_batch_backup, cvar_lp_batch_backup, read_batch_solution
+
+try:
+    import highspy
+except ImportError:
+    highspy = None
+
+# REGISTRY OF THE BACKENDS THAT SOLVE THE CVAR BELLMAN BACKUPS, AND THE SWEEP THAT DISPATCHES THROUGH THEM
+
+
+class CvarBackend:
+    """
+    Base class of the CVaR backup backends.
+
+    A backend turns the frozen value function of a sweep into the Q-values of a set of states. Subclasses implement
+    backup_state (one state at a time), backup_batch (several states per solver call) or override backup_states
+    (many states at once, vectorized = True). Stateful backends keep data between calls and therefore always run
+    serially in the calling process.
+
+    Parameters:
+    time_limit (float, optional): Time limit in seconds of each solver call, where the solver supports one.
+    threads (int, optional): Number of solver threads, where the solver supports it.
+    states_per_batch (int, optional): States packed into one block-diagonal LP per solver call, where the backend
+        supports it. Defaults to 1.
+    """
+
+    name = None
+    vectorized = False
+    stateful = False
+
+    def __init__(self, time_limit=None, threads=None, states_per_batch=1):
+        self.time_limit = time_limit
+        self.threads = threads
+        self.states_per_batch = max(1, int(states_per_batch))
+
+    @classmethod
+    def available(cls):
+        """ Whether the solver this backend needs is installed. """
+        return True
+
+    def report(self):
+        """ Solver statistics of the run so far, None if the backend keeps none. """
+        return None
+
+    def backup_state(self, mdp, s_id, V_, alpha_set, discount, atoms=None):
+        raise NotImplementedError
+
+    def backup_batch(self, mdp, V_, alpha_set_all, discount, state_ids, atoms=None):
+        return np.array([self.backup_state(mdp, s_id, V_, alpha_set_all[s_id], discount, atoms) for s_id in state_ids])
+
+    def backup_states(self, mdp, V_, alpha_set_all, discount, state_ids, atoms=None):
+        """
+        Backs up the given states, returning their Q-values stacked as (len(state_ids), Na, Ny).
+        atoms is an optional boolean mask of the alpha atoms to back up; the Q-values of the others are undefined.
+        """
+        return np.concatenate([self.backup_batch(mdp, V_, alpha_set_all, discount, state_ids[i:i + self.states_per_batch],
+                                                 atoms)
+                               for i in range(0, len(state_ids), self.states_per_batch)])
+
+
+class PulpBackend(CvarBackend):
+    """ PuLP models of states_per_batch states each, solved by the PuLP solver class given by SOLVER. """
+
+    SOLVER = None
+
+    @classmethod
+    def available(cls):
+        return bool(cls.SOLVER(msg=False).available())
+
+    def lp_solver(self):
+        return self.SOLVER(msg=False, timeLimit=self.time_limit, threads=self.threads)
+
+    def backup_batch(self, mdp, V_, alpha_set_all, discount, state_ids, atoms=None):
+        return cvar_lp_batch_backup(mdp, state_ids, V_, alpha_set_all[state_ids], discount, lp_solver=self.lp_solver(),
+                                    atoms=atoms)
+
+
+class CbcBackend(PulpBackend):
+    name = 'cbc'
+    SOLVER = PULP_CBC_CMD
+
+
+class CplexBackend(PulpBackend):
+    name = 'cplex'
+    SOLVER = CPLEX_PY
+
+
+class HighsBackend(CvarBackend):
+    """ Matrix-form LPs of states_per_batch states solved by scipy's HiGHS, which has no thread option (ignored). """
+
+    name = 'highs'
+
+    def backup_batch(self, mdp, V_, alpha_set_all, discount, state_ids, atoms=None):
+        options = {} if self.time_limit is None else {'time_limit': self.time_limit}
+        return cvar_highs_batch_backup(mdp, state_ids, V_, alpha_set_all[state_ids], discount, options=options,
+                                       atoms=atoms)
+
+
+class PersistentHighsBackend(CvarBackend):
+    """
+    CVaR backup that keeps one HiGHS model per state (or batch of states) alive across sweeps.
+
+    The LP of a state keeps its dimensions from one sweep to the next; only the slopes and right-hand sides derived
+    from V_ change. Each call passes the refreshed LP to the cached model in one passModel call, restores the basis
+    of the previous solve and re-runs the simplex from there, so sweeps close to convergence cost a few pivots
+    instead of a cold solve. Updating the model in place instead takes one changeCoeff call per changed slope, which
+    costs more than the full pass on these LPs. The models live in this object, so one instance has to be reused for the whole run, serially.
+    Models are keyed by the states of their batch, so batches should stay the same from one sweep to the next.
+    Requires the optional highspy package.
+    """
+
+    name = 'highs_persistent'
+    stateful = True
+    # the counterpart of cvar_backup.HIGHS_RETRIES: on a degenerate LP the warm started simplex can stop with
+    # numerical difficulties (model status Unknown), the LP is then solved again from scratch with these options
+    RETRIES = ({'solver': 'ipm'}, {'solver': 'ipm', 'presolve': 'off'}, {'solver': 'simplex', 'presolve': 'off'})
+
+    def __init__(self, time_limit=None, threads=None, states_per_batch=1):
+        super().__init__(time_limit, threads, states_per_batch)
+        if highspy is None:
+            raise ImportError("The persistent HiGHS backend requires the 'highspy' package")
+        self.models = {}
+        self.solves = 0
+        self.retries = 0
+        self.simplex_iterations = 0
+
+    @classmethod
+    def available(cls):
+        return highspy is not None
+
+    def report(self):
+        return 'HiGHS solves: %d (%d retries), simplex iterations: %d' % (self.solves, self.retries,
+                                                                         self.simplex_iterations)
+
+    def backup_batch(self, mdp, V_, alpha_set_all, discount, state_ids, atoms=None):
+        objectives, layouts, lp = assemble_batch_lp(mdp, state_ids, V_, alpha_set_all[state_ids], discount, atoms)
+        if lp is None:
+            return np.array(objectives)
+        key = tuple(state_ids)
+
+        c, A_ub, b_ub, A_eq, b_eq, bounds = lp
+        A = vstack((A_ub, A_eq), format='csr')
+        # the model changes shape with the alpha grid and the backed up atoms, a basis only carries over while the
+        # layout stays the same
+        signature = A.shape, None if atoms is None else atoms.tobytes()
+        row_lower = np.concatenate((np.full(len(b_ub), -highspy.kHighsInf), b_eq))
+        row_upper = np.concatenate((b_ub, b_eq))
+
+        h, basis, basis_signature = self.models.get(key, (None, None, None))
+        if h is None:
+            h = highspy.Highs()
+            h.setOptionValue('output_flag', False)
+            if self.time_limit is not None:
+                h.setOptionValue('time_limit', float(self.time_limit))
+            if self.threads is not None:
+                h.setOptionValue('threads', int(self.threads))
+        h.passModel(A.shape[1], A.shape[0], A.nnz, int(highspy.MatrixFormat.kRowwise), int(highspy.ObjSense.kMinimize),
+                    0., c, bounds[:, 0], bounds[:, 1], row_lower, row_upper,
+                    A.indptr[:-1].astype(np.int32), A.indices.astype(np.int32), A.data,
+                    np.zeros(A.shape[1], dtype=np.int32))
+        if basis is not None and basis_signature == signature:
+            h.setBasis(basis)
+        h.run()
+        for retry_options in self.RETRIES:
+            if h.getModelStatus() != highspy.HighsModelStatus.kUnknown:
+                break
+            h.clearSolver()
+            for option, value in retry_options.items():
+                h.setOptionValue(option, value)
+            h.run()
+            for option in retry_options:
+                h.setOptionValue(option, 'choose')
+            self.retries += 1
+        if h.getModelStatus() != highspy.HighsModelStatus.kOptimal:
+            self.models.pop(key, None)
+            raise SolverError(self.name, h.modelStatusToString(h.getModelStatus()),
+                              state_ids[0] if len(state_ids) == 1 else list(state_ids))
+
+        self.models[key] = (h, h.getBasis(), signature)
+        self.solves += 1
+        self.simplex_iterations += h.getInfo().simplex_iteration_count
+        return read_batch_solution(objectives, layouts, c, np.array(h.getSolution().col_value))
+
+
+class HighsBlockBackend(CvarBackend):
+    """
+    Solves every (action, alpha) block of a state as its own small scipy HiGHS LP (see cvar_action_backup).
+
+    A block that fails reports its state, action and alpha instead of failing the whole state LP, and time_limit
+    applies per block. With reuse_unchanged the backend remembers the successor values each action was last backed
+    up from and skips the LPs of actions whose inputs did not change since. With cache_size, the solved blocks go to
+    a BackupCache shared by all states and sweeps (see backup_cache.BackupCache, configured by cache_policy and
+    cache_tolerance). Both make the backend stateful (serial).
+    """
+
+    name = 'highs_blocks'
+
+    def __init__(self, time_limit=None, threads=None, states_per_batch=1, reuse_unchanged=False, cache_size=None,
+                 cache_policy='lru', cache_tolerance=1e-12):
+        super().__init__(time_limit, threads, states_per_batch)
+        self.reuse_unchanged = reuse_unchanged
+        self.cache = None if cache_size is None else BackupCache(cache_size, cache_policy, cache_tolerance)
+        self.stateful = reuse_unchanged or self.cache is not None
+        # (s_id, a) -> (successor values, alpha atoms, backed up atoms, discount, Q-values)
+        self.blocks = {}
+        self.solved_blocks = 0
+        self.reused_blocks = 0
+
+    def report(self):
+        report = 'LP blocks solved: %d, reused: %d' % (self.solved_blocks, self.reused_blocks)
+        return report if self.cache is None else report + ', ' + self.cache.report()
+
+    def backup_state(self, mdp, s_id, V_, alpha_set, discount, atoms=None):
+        options = {} if self.time_limit is None else {'time_limit': self.time_limit}
+        atoms = np.ones(len(alpha_set), dtype=bool) if atoms is None else atoms
+        objective = np.full((mdp.Na, len(alpha_set)), -np.inf)
+        for a in np.flatnonzero(mdp.action_mask[s_id]):
+            next_ids, probs, rewards = mdp.row(s_id, a)
+            successor_V = V_[:, next_ids]
+            n_blocks = int(((alpha_set > 0) & atoms).sum())
+            cached = self.blocks.get((s_id, a))
+            if cached is not None and cached[3] == discount and np.array_equal(cached[1], alpha_set) \
+                    and np.array_equal(cached[2], atoms) and np.array_equal(cached[0], successor_V):
+                objective[a] = cached[4]
+                self.reused_blocks += n_blocks
+                continue
+            solve, keys = atoms, None
+            if self.cache is not None:
+                key = self.cache.action_key(probs, rewards, successor_V, alpha_set, discount)
+                keys = {idx: (key, idx) for idx in np.flatnonzero((alpha_set > 0) & atoms)}
+                stored = {idx: self.cache.get(block) for idx, block in keys.items()}
+                stored = {idx: value for idx, value in stored.items() if value is not None}
+                solve = atoms.copy()
+                solve[list(stored)] = False
+            try:
+                objective[a] = cvar_action_backup(probs, rewards, successor_V, alpha_set, discount, options, solve)
+            except SolverError as e:
+                raise SolverError(e.backend, '%s, action %d' % (e.status, a), s_id) from None
+            if keys is not None:
+                for idx, block in keys.items():
+                    if idx in stored:
+                        objective[a, idx] = stored[idx]
+                    else:
+                        self.cache.put(block, objective[a, idx])
+                self.reused_blocks += len(stored)
+                n_blocks -= len(stored)
+            self.solved_blocks += n_blocks
+            if self.reuse_unchanged:
+                self.blocks[(s_id, a)] = (successor_V, np.array(alpha_set), atoms.copy(), discount, objective[a].copy())
+        return objective
+
+
+class ClosedFormBackend(CvarBackend):
+    """
+    The LP-free engine of cvar_closed_form_backup; it solves no LP, so time_limit and threads are ignored, and it
+    computes every atom at once regardless of atoms.
+    """
+
+    name = 'closed_form'
+    vectorized = True
+
+    def backup_states(self, mdp, V_, alpha_set_all, discount, state_ids, atoms=None):
+        return cvar_closed_form_backup(mdp, V_, alpha_set_all[state_ids], discount, state_ids)
+
+
+class FallbackBackend(CvarBackend):
+    """
+    Tries its backends in order for every chunk of states, moving on to the next one when a backend raises.
+
+    A backend that cannot even run on this node (missing solver) is skipped for the rest of the run.
+    """
+
+    def __init__(self, backends):
+        super().__init__()
+        self.backends = list(backends)
+        self.name = '+'.join(b.name for b in self.backends)
+        self.vectorized = any(b.vectorized for b in self.backends)
+        self.stateful = any(b.stateful for b in self.backends)
+        self.states_per_batch = max(b.states_per_batch for b in self.backends)
+
+    def report(self):
+        reports = [b.report() for b in self.backends if b.report()]
+        return '; '.join(reports) if reports else None
+
+    def backup_states(self, mdp, V_, alpha_set_all, discount, state_ids, atoms=None):
+        errors = []
+        for backend in list(self.backends):
+            try:
+                return backend.backup_states(mdp, V_, alpha_set_all, discount, state_ids, atoms)
+            except SolverError as e:
+                errors.append(e)
+                print('Backend %s failed (%s), falling back' % (backend.name, e))
+            except Exception as e:
+                if backend.available():
+                    raise
+                errors.append(e)
+                self.backends.remove(backend)
+                print('Backend %s is not available (%s), dropping it' % (backend.name, e))
+        raise errors[-1]
+
+
+BACKENDS = {}
+
+
+def register_backend(backend_class, name=None):
+    """ Registers a CvarBackend subclass under its name (or the given one), so runs can select it by string. """
+    BACKENDS[name or backend_class.name] = backend_class
+    return backend_class
+
+
+for _backend_class in (CbcBackend, CplexBackend, HighsBackend, PersistentHighsBackend, HighsBlockBackend,
+                       ClosedFormBackend):
+    register_backend(_backend_class)
+
+
+def available_backends():
+    """ Names of the registered backends whose solver is installed on this node, in registration order. """
+    return [name for name, backend_class in BACKENDS.items() if backend_class.available()]
+
+
+# backends from fastest to slowest, for engine='auto'
+SPEED_ORDER = ['closed_form', 'highs_persistent', 'highs', 'highs_blocks', 'cplex', 'cbc']
+
+
+def make_backend(engine='cplex', fallback=(), **options):
+    """
+    Creates the backend a whole run should reuse.
+
+    Parameters:
+    engine (str | CvarBackend): A registered backend name, a backend instance which is returned as is, or 'auto' for
+        the fastest backend installed on this node (see SPEED_ORDER).
+    fallback (sequence, optional): Backend names or instances tried in order when engine fails. Defaults to none.
+    options: Per-backend options (time_limit, threads, states_per_batch) for the backends created from names.
+
+    Returns:
+    CvarBackend: The backend.
+    """
+    if isinstance(engine, str) and engine == 'auto':
+        available = available_backends()
+        engine = next(name for name in SPEED_ORDER + available if name in available)
+    backends = []
+    for spec in [engine] + list(fallback):
+        if isinstance(spec, CvarBackend):
+            backends.append(spec)
+        elif spec in BACKENDS:
+            backends.append(BACKENDS[spec](**options))
+        else:
+            raise ValueError("Unknown backend '%s', expected one of %s" % (spec, list(BACKENDS)))
+    return backends[0] if len(backends) == 1 else FallbackBackend(backends)
+
+
+def cvar_backups(mdp, V_, alpha_set_all, discount=0.95, state_ids=None, n_jobs=1, chunk_size=None, desc='Value Update',
+                 engine='cplex', atoms=None):
+    """
+    Backs up every state against the frozen value function V_ with the given backend, serially or with a process pool.
+
+    States only read V_, so a sweep splits into independent chunks. With n_jobs != 1 the chunks are dispatched to
+    joblib workers, which receive V_ as a shared read-only memmap once it is large enough, and the results are
+    gathered back in state order. Both paths run the same backups, so they return identical values. Stateful
+    backends always run serially.
+
+    Parameters:
+    mdp (TransitionTensor): The compiled world.
+    V_ (np.array): The frozen value function of the sweep, shape (Ny, Ns).
+    alpha_set_all (np.array): Array of alpha values for each state.
+    discount (float, optional): The discount factor for future rewards. Defaults to 0.95.
+    state_ids (np.array, optional): The states to back up. Defaults to every state of the world.
+    n_jobs (int, optional): Number of worker processes, -1 for all cores. Defaults to 1 (serial).
+    chunk_size (int, optional): States per task or vectorized batch. Defaults to 4 tasks per worker in parallel,
+        one LP batch (states_per_batch) per step for LP backends and all states at once for vectorized ones when
+        serial.
+    desc (str, optional): Progress bar description.
+    engine (str | CvarBackend, optional): Backend name (see BACKENDS) or instance. Defaults to 'cplex'.
+    atoms (np.array, optional): Boolean mask of the alpha atoms to back up. Defaults to every atom.
+
+    Returns:
+    np.array: Q-values of shape (len(state_ids), Na, Ny).
+    """
+    backend = make_backend(engine)
+    if state_ids is None:
+        state_ids = mdp.state_ids
+    if len(state_ids) == 0:
+        return np.zeros((0, mdp.Na, alpha_set_all.shape[1]))
+
+    if n_jobs == 1 or backend.stateful:
+        chunk_size = chunk_size or (len(state_ids) if backend.vectorized else backend.states_per_batch)
+        Q = []
+        with tqdm(total=len(state_ids), desc=desc) as progress:
+            for i in range(0, len(state_ids), chunk_size):
+                Q.append(backend.backup_states(mdp, V_, alpha_set_all, discount, state_ids[i:i + chunk_size], atoms))
+                progress.update(len(Q[-1]))
+        return np.concatenate(Q)
+
+    if chunk_size is None:
+        chunk_size = max(1, int(np.ceil(len(state_ids) / (4 * effective_n_jobs(n_jobs)))))
+    chunks = [state_ids[i:i + chunk_size] for i in range(0, len(state_ids), chunk_size)]
+    results = Parallel(n_jobs=n_jobs, return_as='generator')(
+        delayed(backend.backup_states)(mdp, V_, alpha_set_all, discount, chunk, atoms) for chunk in chunks)
+    return np.concatenate(list(tqdm(results, total=len(chunks), desc=desc)))
+
+
+def cvar_in_place_backups(mdp, V, alpha_set_all, value_of, discount=0.95, state_ids=None, chunk_size=None,
+                          desc='Value Update', engine='cplex', atoms=None):
+    """
+    Gauss-Seidel counterpart of cvar_backups: backs up the states in the given order and writes their new values
+    into V right away, so later states of the same sweep already back up from the fresh values of earlier ones.
+
+    Parameters:
+    mdp (TransitionTensor): The compiled world.
+    V (np.array): The value function, shape (Ny, Ns), updated in place.
+    alpha_set_all (np.array): Array of alpha values for each state.
+    value_of (callable): Maps the state ids of a chunk and their Q-values (states, Na, Ny) to their new values
+        (Ny, states).
+    discount (float, optional): The discount factor for future rewards. Defaults to 0.95.
+    state_ids (np.array, optional): The states to back up, in sweep order. Defaults to every state of the world.
+    chunk_size (int, optional): States backed up together before their values are written. Defaults to the
+        backend's states_per_batch.
+    desc (str, optional): Progress bar description.
+    engine (str | CvarBackend, optional): Backend name (see BACKENDS) or instance. Defaults to 'cplex'.
+    atoms (np.array, optional): Boolean mask of the alpha atoms to back up. Defaults to every atom.
+
+    Returns:
+    np.array: Q-values of shape (len(state_ids), Na, Ny), in sweep order.
+    """
+    backend = make_backend(engine)
+    if state_ids is None:
+        state_ids = mdp.state_ids
+    chunk_size = chunk_size or backend.states_per_batch
+    Q = [np.zeros((0, mdp.Na, alpha_set_all.shape[1]))]
+    with tqdm(total=len(state_ids), desc=desc) as progress:
+        for i in range(0, len(state_ids), chunk_size):
+            ids = state_ids[i:i + chunk_size]
+            Q.append(backend.backup_states(mdp, V, alpha_set_all, discount, ids, atoms))
+            V[:, ids] = value_of(ids, Q[-1])
+            progress.update(len(ids))
+    return np.concatenate(Q)
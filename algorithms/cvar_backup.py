@@ -0,0 +1,529 @@
+import numpy as np
+from pulp import LpProblem, LpVariable, LpMinimize, LpStatusOptimal, LpStatus, CPLEX_PY, lpSum
+from scipy.optimize import linprog
+from scipy.sparse import block_diag, csr_matrix
+
+# IMPLEMENTATION OF THE CVAR BELLMAN BACKUP (PER-STATE LP OR CLOSED FORM), SHARED BY THE SWEEPS
+
+
+class SolverError(Exception):
+    """ Raised when a solver cannot produce an optimal solution for a backup; s_id lists the states of a batch. """
+
+    def __init__(self, backend, status, s_id=None):
+        self.backend = backend
+        self.status = status
+        self.s_id = s_id
+        super().__init__(f"{backend}: no optimal solution found (status: {status}, state: {s_id})")
+
+
+def solve_problem(solver, lp_solver=None):
+    """
+    Solves the optimization problem using the provided solver.
+
+    Parameters:
+    solver (LpProblem): An instance of the PuLP LpProblem class used to define and solve the optimization problem.
+    lp_solver (LpSolver, optional): The PuLP solver to use. Defaults to CPLEX_PY(msg=False).
+
+    Returns:
+    tuple: A tuple containing two numpy arrays:
+        - solved_xi (np.array): Array of solution values for variables starting with 'xi'.
+        - solved_t (np.array): Array of solution values for variables starting with 't'.
+
+    Raises:
+    SolverError: If no optimal solution is found.
+    """
+    if lp_solver is None:
+        lp_solver = CPLEX_PY(msg=False)
+    solver.solve(lp_solver)
+    if solver.status == LpStatusOptimal:
+        solved_xi = []
+        solved_t = []
+        solved_xi_names = []
+        solved_t_names = []
+        for v in solver.variables():
+            if v.name.startswith('xi'):
+                solved_xi.append(v.varValue)
+                solved_xi_names.append(v.name)
+            elif v.name.startswith('t'):
+                solved_t.append(v.varValue)
+                solved_t_names.append(v.name)
+
+        # Sort t values by their original order
+        solved_t = [t for _, t in sorted(zip(solved_t_names, solved_t), key=lambda x: int(x[0].split('_')[1]))]
+        solved_xi = [t for _, t in sorted(zip(solved_xi_names, solved_xi), key=lambda x: int(x[0].split('_')[1]))]
+        return np.array(solved_xi), np.array(solved_t)
+    else:
+        raise SolverError(lp_solver.name, LpStatus[solver.status])
+
+
+def create_decision_variables(prefix, n_vars, bounds=None, start_index=0):
+    """
+    Create an array of decision variables with consistent naming and bounds.
+
+    Parameters:
+        prefix: String prefix for variable names (e.g., 'xi', 't')
+        n_vars: Number of variables to create
+        bounds: Tuple of (lower_bound, upper_bound) or None for default bounds
+        start_index: Starting index for variable naming
+
+    Returns:
+        array of decision variables, next available index
+    """
+
+    variables = np.array([
+        LpVariable(f'{prefix}_{i + start_index}', lowBound=bounds[0], upBound=bounds[1])
+        for i in range(n_vars)
+    ])
+
+    return variables, start_index + n_vars
+
+
+def dynamic_reshape(arr, n_trans_list, num_alpha):
+    # Calculate cumulative sizes for splitting
+    split_indices = np.cumsum([0] + [(num_alpha - 1) * n for n in n_trans_list])
+
+    # Split the array based on n_trans_list
+    split_arrays = np.split(arr, split_indices[1:-1])
+
+    # Reshape each split array
+    reshaped_arrays = [arr_split.reshape(num_alpha - 1, n_trans)
+                       for arr_split, n_trans in zip(split_arrays, n_trans_list)]
+    return reshaped_arrays
+
+
+def cvar_lp_backup(mdp, s_id, V_, alpha_set, discount=0.95, lp_solver=None, atoms=None):
+    """
+    Solves the CVaR Bellman backup LP of a single state.
+
+    Parameters:
+    mdp (TransitionTensor): The compiled world.
+    s_id (int): The id of the state to back up.
+    V_ (np.array): The frozen value function of the sweep, shape (Ny, Ns).
+    alpha_set (np.array): The alpha atoms of the state.
+    discount (float, optional): The discount factor for future rewards. Defaults to 0.95.
+    lp_solver (LpSolver, optional): The PuLP solver to use. Defaults to CPLEX_PY(msg=False).
+    atoms (np.array, optional): Boolean mask of the alpha atoms to back up; the others are left out of the LP and
+        come back as NaN. Defaults to every atom.
+
+    Returns:
+    np.array: Q-values of shape (Na, Ny), -inf for unavailable actions.
+    """
+    return cvar_lp_batch_backup(mdp, [s_id], V_, np.asarray(alpha_set)[None], discount, lp_solver, atoms)[0]
+
+
+def cvar_lp_batch_backup(mdp, state_ids, V_, alpha_sets, discount=0.95, lp_solver=None, atoms=None):
+    """
+    Solves the CVaR Bellman backup LPs of several states with a single solver call.
+
+    The states share no variables or constraints, so their LPs are stacked into one block-diagonal model whose
+    objective is the sum of theirs; the solution is split back per state afterwards. This pays the model writing,
+    solver start-up and result parsing overhead once per batch instead of once per state.
+
+    Parameters:
+    mdp (TransitionTensor): The compiled world.
+    state_ids (list): The ids of the states to back up.
+    V_ (np.array): The frozen value function of the sweep, shape (Ny, Ns).
+    alpha_sets (np.array): The alpha atoms of each state, shape (len(state_ids), Ny).
+    discount (float, optional): The discount factor for future rewards. Defaults to 0.95.
+    lp_solver (LpSolver, optional): The PuLP solver to use. Defaults to CPLEX_PY(msg=False).
+    atoms (np.array, optional): Boolean mask of the alpha atoms to back up, see cvar_lp_backup.
+
+    Returns:
+    np.array: Q-values of shape (len(state_ids), Na, Ny), -inf for unavailable actions.
+    """
+    ts = np.array([])
+    solver = LpProblem(name='cvar_value', sense=LpMinimize)
+    atoms = np.ones(alpha_sets.shape[1], dtype=bool) if atoms is None else atoms
+    objectives = np.where(atoms, 0., np.nan) * np.ones((len(state_ids), mdp.Na, 1))
+
+    counter = 0
+    n_trans_lists = []
+    for s_idx, s_id in enumerate(state_ids):
+        alpha_set = alpha_sets[s_idx]
+        n_trans_list = []
+        for a in np.flatnonzero(mdp.action_mask[s_id]):
+            transitions_ids, transitions_probabilities, transitions_rewards = mdp.row(s_id, a)
+            n_trans = len(transitions_ids)
+            n_trans_list.append(n_trans)
+            for alpha_idx, alpha in enumerate(alpha_set):
+                if not atoms[alpha_idx]:
+                    continue
+                if alpha == 0:
+                    # when alpha is 0, the cvar is simply the worst case value, so no expectation over some distribution
+                    objectives[s_idx, a, alpha_idx] = min(
+                        (transitions_rewards + discount * V_[alpha_idx, transitions_ids]) * transitions_probabilities)
+                    continue
+
+                # Create xi variables (non-negative)
+                xi, counter = create_decision_variables(
+                    prefix='xi',
+                    n_vars=n_trans,
+                    bounds=(0, None),
+                    start_index=counter
+                )
+                solver += xi @ transitions_probabilities == 1
+
+                t, counter = create_decision_variables(
+                    prefix='t',
+                    n_vars=n_trans,
+                    bounds=(-1e6, 1e6),
+                    start_index=counter
+                )
+                ts = np.append(ts, xi * transitions_probabilities * transitions_rewards + t)
+                for i in range(len(alpha_set) - 1):
+                    alpha_i = alpha_set[i]
+                    alpha_i_next = alpha_set[i + 1]
+                    v_i = V_[i, transitions_ids]
+                    v_i_next = V_[i + 1, transitions_ids]
+                    slope = (alpha_i_next * v_i_next - alpha_i * v_i) / (alpha_i_next - alpha_i)
+
+                    right_ineq = (alpha_i * v_i / alpha - slope * alpha_i / alpha) * discount * transitions_probabilities
+                    left_ineq = t - slope * xi * discount * transitions_probabilities
+                    for idx in range(len(right_ineq)):
+                        solver += left_ineq[idx] >= right_ineq[idx]
+                        solver += xi[idx] <= 1 / alpha
+        n_trans_lists.append(n_trans_list)
+
+    if not len(ts):
+        # only alpha = 0 atoms or no available actions: nothing for the solver to do
+        return np.where(mdp.action_mask[state_ids][..., None], objectives, -np.inf)
+
+    solver += lpSum(ts)
+    try:
+        xi_values, t_values = solve_problem(solver, lp_solver)
+    except SolverError as e:
+        raise SolverError(e.backend, e.status, state_ids[0] if len(state_ids) == 1 else list(state_ids)) from None
+
+    offset = 0
+    for s_idx, (s_id, n_trans_list) in enumerate(zip(state_ids, n_trans_lists)):
+        lp_atoms = np.flatnonzero((alpha_sets[s_idx] > 0) & atoms)
+        size = len(lp_atoms) * sum(n_trans_list)
+        xi_state = dynamic_reshape(xi_values[offset:offset + size], n_trans_list, len(lp_atoms) + 1)
+        t_state = dynamic_reshape(t_values[offset:offset + size], n_trans_list, len(lp_atoms) + 1)
+        offset += size
+        for idx, a in enumerate(np.flatnonzero(mdp.action_mask[s_id])):
+            _, transitions_probabilities, transitions_rewards = mdp.row(s_id, a)
+            objectives[s_idx, a, lp_atoms] = (xi_state[idx] * transitions_rewards * transitions_probabilities
+                                              + t_state[idx]).sum(-1)
+
+    return np.where(mdp.action_mask[state_ids][..., None], objectives, -np.inf)
+
+
+def assemble_cvar_lp(probs, rewards, slopes, intercepts, alphas, discount):
+    """
+    Assembles the CVaR backup LP of B independent (action, alpha) blocks that share n successors in matrix form.
+
+    Block b owns the variables [xi_0 .. xi_{n-1}, t_0 .. t_{n-1}] at columns b * 2n onwards and mirrors the
+    PuLP model of cvar_lp_backup: minimize sum_j xi_j p_j r_j + t_j subject to sum_j xi_j p_j = 1,
+    t_j >= discount * p_j * (slope_ij * xi_j + intercept_ij / alpha) for every chord i, 0 <= xi_j <= 1 / alpha.
+
+    Parameters:
+    probs (np.array): Transition probabilities, shape (B, n).
+    rewards (np.array): Transition rewards, shape (B, n).
+    slopes (np.array): Chord slopes of the successors' alpha * V(alpha), shape (B, m, n).
+    intercepts (np.array): Chord values at alpha = 0, shape (B, m, n).
+    alphas (np.array): The alpha of each block, shape (B,).
+    discount (float): The discount factor for future rewards.
+
+    Returns:
+    tuple: (c, A_ub, b_ub, A_eq, b_eq, bounds) in scipy.optimize.linprog form.
+    """
+    B, m, n = slopes.shape
+    xi_cols = np.arange(B)[:, None] * 2 * n + np.arange(n)
+    t_cols = xi_cols + n
+
+    c = np.concatenate((probs * rewards, np.ones((B, n))), axis=1).ravel()
+
+    A_eq = csr_matrix((probs.ravel(), (np.repeat(np.arange(B), n), xi_cols.ravel())), shape=(B, 2 * n * B))
+    b_eq = np.ones(B)
+
+    # one row per (block, chord, successor): discount * p_j * slope_ij * xi_j - t_j <= -discount * p_j * intercept_ij / alpha
+    rows = np.arange(B * m * n)
+    xi_idx = np.broadcast_to(xi_cols[:, None, :], (B, m, n)).ravel()
+    t_idx = np.broadcast_to(t_cols[:, None, :], (B, m, n)).ravel()
+    weights = discount * probs[:, None, :]
+    A_ub = csr_matrix((np.concatenate(((weights * slopes).ravel(), -np.ones(B * m * n))),
+                       (np.concatenate((rows, rows)), np.concatenate((xi_idx, t_idx)))), shape=(B * m * n, 2 * n * B))
+    b_ub = (-weights * intercepts / alphas[:, None, None]).ravel()
+
+    bounds = np.empty((B, 2 * n, 2))
+    bounds[:, :n, 0] = 0
+    bounds[:, :n, 1] = 1 / alphas[:, None]
+    bounds[:, n:, 0] = -1e6
+    bounds[:, n:, 1] = 1e6
+    return c, A_ub, b_ub, A_eq, b_eq, bounds.reshape(-1, 2)
+
+
+def successor_chords(V_, alpha_set, next_ids):
+    """
+    Chords of the interpolated alpha * V(alpha) curves of the successors.
+
+    Returns:
+    tuple: (slopes, intercepts), both of shape (Ny - 1, n); intercepts are the chord values at alpha = 0.
+    """
+    return chords(V_[:, next_ids], alpha_set)
+
+
+def chords(successor_V, alpha_set):
+    """ Chords of alpha * V(alpha) for successor values of shape (Ny, n), see successor_chords. """
+    av = alpha_set[:, None] * successor_V
+    slopes = np.diff(av, axis=0) / np.diff(alpha_set)[:, None]
+    intercepts = av[:-1] - slopes * alpha_set[:-1, None]
+    return slopes, intercepts
+
+
+def assemble_state_lp(mdp, s_id, V_, alpha_set, discount, atoms=None):
+    """
+    Assembles the block-diagonal LP of one state, one group of (action, alpha) blocks per available action.
+    Only the alpha atoms in the boolean mask atoms (default all) get blocks; the others are left as NaN.
+
+    Returns:
+    tuple: A tuple containing:
+        - objective (np.array): Q-values of shape (Na, Ny), already filled for alpha = 0 and unavailable actions.
+        - layout (list): (action, number of LP columns, alpha indices) of every group, in column order.
+        - lp (tuple): (c, A_ub, b_ub, A_eq, b_eq, bounds) in scipy.optimize.linprog form, None if there is no LP.
+    """
+    atoms = np.ones(len(alpha_set), dtype=bool) if atoms is None else atoms
+    objective = np.full((mdp.Na, len(alpha_set)), -np.inf)
+    objective[np.ix_(mdp.action_mask[s_id], ~atoms)] = np.nan
+    positive = np.flatnonzero((alpha_set > 0) & atoms)
+    zero = np.flatnonzero((alpha_set == 0) & atoms)
+
+    layout, groups = [], []
+    for a in np.flatnonzero(mdp.action_mask[s_id]):
+        next_ids, probs, rewards = mdp.row(s_id, a)
+        # when alpha is 0, the cvar is simply the worst case value, so no expectation over some distribution
+        objective[a, zero] = ((rewards + discount * V_[zero][:, next_ids]) * probs).min(axis=1)
+        slopes, intercepts = successor_chords(V_, alpha_set, next_ids)
+        B = len(positive)
+        groups.append(assemble_cvar_lp(np.tile(probs, (B, 1)), np.tile(rewards, (B, 1)),
+                                       np.broadcast_to(slopes, (B,) + slopes.shape),
+                                       np.broadcast_to(intercepts, (B,) + intercepts.shape),
+                                       alpha_set[positive], discount))
+        layout.append((a, len(groups[-1][0]), positive))
+
+    if not groups or not len(positive):
+        return objective, layout, None
+
+    # the actions of a state are independent blocks of one block-diagonal LP
+    lp = (np.concatenate([g[0] for g in groups]),
+          block_diag([g[1] for g in groups], format='csr'),
+          np.concatenate([g[2] for g in groups]),
+          block_diag([g[3] for g in groups], format='csr'),
+          np.concatenate([g[4] for g in groups]),
+          np.concatenate([g[5] for g in groups]))
+    return objective, layout, lp
+
+
+def read_state_solution(objective, layout, c, x):
+    """ Reads the Q-values of a solved state LP back by position: block objectives are the Q-values. """
+    offset = 0
+    for a, size, positive in layout:
+        objective[a, positive] = (c[offset:offset + size] * x[offset:offset + size]).reshape(len(positive), -1).sum(axis=1)
+        offset += size
+    return objective
+
+
+def assemble_batch_lp(mdp, state_ids, V_, alpha_sets, discount, atoms=None):
+    """
+    Stacks the LPs of several states into one block-diagonal LP, see assemble_state_lp.
+
+    Returns:
+    tuple: A tuple containing:
+        - objectives (list): The per-state objective arrays of assemble_state_lp.
+        - layouts (list): The per-state layouts of assemble_state_lp, in column order.
+        - lp (tuple): (c, A_ub, b_ub, A_eq, b_eq, bounds) of the whole batch, None if there is no LP.
+    """
+    objectives, layouts, lps = [], [], []
+    for s_id, alpha_set in zip(state_ids, alpha_sets):
+        objective, layout, lp = assemble_state_lp(mdp, s_id, V_, alpha_set, discount, atoms)
+        objectives.append(objective)
+        layouts.append(layout if lp is not None else [])
+        if lp is not None:
+            lps.append(lp)
+
+    if not lps:
+        return objectives, layouts, None
+    if len(lps) == 1:
+        return objectives, layouts, lps[0]
+    lp = (np.concatenate([lp[0] for lp in lps]),
+          block_diag([lp[1] for lp in lps], format='csr'),
+          np.concatenate([lp[2] for lp in lps]),
+          block_diag([lp[3] for lp in lps], format='csr'),
+          np.concatenate([lp[4] for lp in lps]),
+          np.concatenate([lp[5] for lp in lps]))
+    return objectives, layouts, lp
+
+
+def read_batch_solution(objectives, layouts, c, x):
+    """ Splits the solution of a batch LP back per state, see read_state_solution. """
+    offset = 0
+    for objective, layout in zip(objectives, layouts):
+        size = sum(n for _, n, _ in layout)
+        read_state_solution(objective, layout, c[offset:offset + size], x[offset:offset + size])
+        offset += size
+    return np.array(objectives)
+
+
+# retried in turn when HiGHS' default (dual simplex with presolve) stops on a degenerate LP with numerical
+# difficulties (status 4, model status Unknown) although the LP is feasible
+HIGHS_RETRIES = (('highs-ipm', {}), ('highs-ipm', {'presolve': False}), ('highs-ds', {'presolve': False}))
+
+
+def solve_highs_lp(c, A_ub, b_ub, A_eq, b_eq, bounds, options=None):
+    """
+    Solves an LP with scipy's HiGHS, retrying with the solvers of HIGHS_RETRIES on numerical difficulties.
+
+    Returns:
+    OptimizeResult: The result of the last attempt; its status is 0 if one of them found the optimum.
+    """
+    options = options or {}
+    result = linprog(c, A_ub=A_ub, b_ub=b_ub, A_eq=A_eq, b_eq=b_eq, bounds=bounds, method='highs', options=options)
+    for method, retry_options in HIGHS_RETRIES:
+        if result.status != 4:
+            break
+        result = linprog(c, A_ub=A_ub, b_ub=b_ub, A_eq=A_eq, b_eq=b_eq, bounds=bounds, method=method,
+                         options={**options, **retry_options})
+    return result
+
+
+def cvar_highs_backup(mdp, s_id, V_, alpha_set, discount=0.95, options=None, atoms=None):
+    """
+    Same backup as cvar_lp_backup, assembled with sparse index arithmetic and solved with scipy's HiGHS.
+    options are passed on to scipy.optimize.linprog (e.g. {'time_limit': 10}).
+
+    Returns:
+    np.array: Q-values of shape (Na, Ny), -inf for unavailable actions.
+    """
+    return cvar_highs_batch_backup(mdp, [s_id], V_, np.asarray(alpha_set)[None], discount, options, atoms)[0]
+
+
+def cvar_highs_batch_backup(mdp, state_ids, V_, alpha_sets, discount=0.95, options=None, atoms=None):
+    """
+    Same backup as cvar_lp_batch_backup: the LPs of all given states are solved by one scipy HiGHS call.
+
+    Returns:
+    np.array: Q-values of shape (len(state_ids), Na, Ny), -inf for unavailable actions.
+    """
+    objectives, layouts, lp = assemble_batch_lp(mdp, state_ids, V_, alpha_sets, discount, atoms)
+    if lp is None:
+        return np.array(objectives)
+
+    c, A_ub, b_ub, A_eq, b_eq, bounds = lp
+    result = solve_highs_lp(c, A_ub, b_ub, A_eq, b_eq, bounds, options)
+    if result.status != 0:
+        raise SolverError('highs', result.message, state_ids[0] if len(state_ids) == 1 else list(state_ids))
+    return read_batch_solution(objectives, layouts, c, result.x)
+
+
+def cvar_block_backup(probs, rewards, slopes, intercepts, alpha, discount, options=None):
+    """
+    Solves a single (action, alpha) block of the state LP on its own with scipy's HiGHS.
+
+    The blocks of a state share no variables or constraints and the state objective is their sum, so solving them
+    separately gives the same Q-values as the joint LP.
+
+    Parameters:
+    probs (np.array): Transition probabilities of the action, shape (n,).
+    rewards (np.array): Transition rewards of the action, shape (n,).
+    slopes (np.array): Chord slopes of the successors' alpha * V(alpha), shape (Ny - 1, n).
+    intercepts (np.array): Chord values at alpha = 0, shape (Ny - 1, n).
+    alpha (float): The (positive) alpha of the block.
+    discount (float): The discount factor for future rewards.
+    options (dict, optional): Options passed on to scipy.optimize.linprog.
+
+    Returns:
+    float: The Q-value of the block.
+    """
+    c, A_ub, b_ub, A_eq, b_eq, bounds = assemble_cvar_lp(probs[None], rewards[None], slopes[None], intercepts[None],
+                                                         np.array([alpha]), discount)
+    result = solve_highs_lp(c, A_ub, b_ub, A_eq, b_eq, bounds, options)
+    if result.status != 0:
+        raise SolverError('highs', '%s (alpha %g)' % (result.message, alpha))
+    return c @ result.x
+
+
+def cvar_action_backup(probs, rewards, successor_V, alpha_set, discount, options=None, atoms=None):
+    """
+    Backs up one action of a state, one independent LP per positive alpha atom (in the boolean mask atoms, if given;
+    the other atoms come back as NaN).
+
+    Parameters:
+    probs (np.array): Transition probabilities of the action, shape (n,).
+    rewards (np.array): Transition rewards of the action, shape (n,).
+    successor_V (np.array): The frozen value function of the successors, shape (Ny, n).
+    alpha_set (np.array): The alpha atoms of the state.
+    discount (float): The discount factor for future rewards.
+    options (dict, optional): Options passed on to scipy.optimize.linprog.
+
+    Returns:
+    np.array: Q-values of the action, shape (Ny,).
+    """
+    # when alpha is 0, the cvar is simply the worst case value, so no expectation over some distribution
+    Q = ((rewards + discount * successor_V) * probs).min(axis=1)
+    slopes, intercepts = chords(successor_V, alpha_set)
+    atoms = np.ones(len(alpha_set), dtype=bool) if atoms is None else atoms
+    Q[~atoms] = np.nan
+    for alpha_idx in np.flatnonzero((alpha_set > 0) & atoms):
+        Q[alpha_idx] = cvar_block_backup(probs, rewards, slopes, intercepts, alpha_set[alpha_idx], discount, options)
+    return Q
+
+
+def cvar_closed_form_backup(mdp, V_, alpha_sets, discount, state_ids):
+    """
+    Computes the CVaR Bellman backup of many states without an LP solver.
+
+    With z_j = alpha * xi_j, the LP of cvar_lp_backup reads, for every (state, action, alpha):
+        alpha * Q(alpha) = min  sum_j p_j * (z_j * r_j + discount * g_j(z_j))
+                           s.t. sum_j p_j * z_j = alpha,  0 <= z_j <= 1
+    where g_j is the upper envelope of the chords of the successor curve alpha * V_(alpha), i.e. its piecewise
+    linear interpolation, which is convex. This is a continuous knapsack with separable convex piecewise linear
+    costs: filling the chord pieces of all successors by increasing marginal cost r_j + discount * slope gives
+    the optimum. The sorted fill does not depend on alpha, so one cumulative cost curve per (state, action)
+    yields alpha * Q(alpha) for every atom at once.
+
+    Parameters:
+    mdp (TransitionTensor): The compiled world.
+    V_ (np.array): The frozen value function of the sweep, shape (Ny, Ns).
+    alpha_sets (np.array): The alpha atoms of each backed up state, shape (len(state_ids), Ny).
+    discount (float): The discount factor for future rewards.
+    state_ids (np.array): The states to back up.
+
+    Returns:
+    np.array: Q-values of shape (len(state_ids), Na, Ny), -inf for unavailable actions.
+    """
+    next_ids, probs, rewards = mdp.padded()
+    next_ids, probs, rewards = next_ids[state_ids], probs[state_ids], rewards[state_ids]
+    counts = np.diff(mdp.indptr).reshape(mdp.Ns, mdp.Na)[state_ids]
+    valid = np.arange(next_ids.shape[-1]) < counts[..., None]
+    alphas = alpha_sets[:, None, None, :]
+
+    # chords of alpha * V_(alpha) for every successor: (states, actions, successors, Ny - 1)
+    av = alphas * np.moveaxis(V_[:, next_ids], 0, -1)
+    slopes = np.diff(av, axis=-1) / np.diff(alphas, axis=-1)
+    # below the first atom and above the last one the envelope follows the outermost chords
+    slopes = np.concatenate((slopes[..., :1], slopes, slopes[..., -1:]), axis=-1)
+    lengths = np.concatenate((alphas[..., :1], np.diff(alphas, axis=-1), 1 - alphas[..., -1:]), axis=-1)
+    value_at_zero = av[..., 0] - slopes[..., 0] * alphas[..., 0]
+
+    costs = rewards[..., None] + discount * slopes
+    masses = probs[..., None] * lengths
+    n_states, n_actions = costs.shape[:2]
+    costs = costs.reshape(n_states, n_actions, -1)
+    masses = masses.reshape(n_states, n_actions, -1)
+    order = np.argsort(costs, axis=-1, kind='stable')
+    costs = np.take_along_axis(costs, order, axis=-1)
+    masses = np.take_along_axis(masses, order, axis=-1)
+    starts = np.cumsum(masses, axis=-1) - masses
+
+    # alpha * Q(alpha): value at z = 0 plus the cheapest pieces filled up to mass alpha
+    filled = np.clip(alpha_sets[:, None, None, :] - starts[..., None], 0, masses[..., None])
+    scaled_Q = discount * (probs * value_at_zero).sum(-1)[..., None] + (costs[..., None] * filled).sum(-2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Q = scaled_Q / alpha_sets[:, None, :]
+
+    # when alpha is 0, the cvar is simply the worst case value, so no expectation over some distribution
+    worst = np.where(valid[..., None], (rewards[..., None] + discount * np.moveaxis(V_[:, next_ids], 0, -1))
+                     * probs[..., None], np.inf).min(axis=2)
+    Q = np.where(alpha_sets[:, None, :] == 0, worst, Q)
+    return np.where(mdp.action_mask[state_ids][..., None], Q, -np.inf)
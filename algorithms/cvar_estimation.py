@@ -0,0 +1,220 @@
+import numpy as np
+from scipy.stats import norm
+
+# IMPLEMENTATION OF A STREAMING ESTIMATOR OF THE VAR AND CVAR OF SAMPLED RETURNS FOR SEVERAL ALPHA AT ONCE
+
+
+class StreamingCvar:
+    """
+    VaR and CVaR of a stream of sampled returns for all alphas in one pass, in bounded memory.
+
+    The estimates follow policy_eval_montecarlo: VaR_alpha = np.quantile(s, alpha) and CVaR_alpha the mean of the
+    returns s <= VaR_alpha. alpha = 0 (the minimum) and alpha = 1 (the mean) are tracked exactly. When num_samples
+    is known, the lowest returns needed by the alphas up to tail_alpha are kept in an unsorted buffer of about
+    tail_alpha * num_samples values, trimmed with np.partition and only sorted when queried, and their estimates are
+    exact. The other alphas are read from a compactor quantile sketch: a level h holds returns standing for 2^h
+    samples each, and a full level is sorted and half of it, every other value from a random offset, moves up a
+    level. Its memory is sketch_size per level, about
+    sketch_size * log2(num_samples / sketch_size) values, and its rank error shrinks like 1 / sketch_size.
+
+    Estimators of the same alphas can be merged, e.g. one per worker, and intervals gives asymptotic confidence
+    intervals of the CVaR estimates.
+
+    Parameters:
+    alphas (np.array): The alpha atoms.
+    num_samples (int, optional): The number of returns that will be streamed, needed for the exact tail.
+        Defaults to None (sketch only).
+    tail_alpha (float, optional): Largest alpha estimated exactly. Defaults to the smallest positive alpha below 1,
+        so the buffer only holds the tail that alpha needs.
+    sketch_size (int, optional): Capacity of a sketch level. Defaults to 2 ** 15.
+    rng (np.random.Generator, optional): Draws the compaction offsets. Defaults to the global numpy state.
+    """
+
+    def __init__(self, alphas, num_samples=None, tail_alpha=None, sketch_size=2 ** 15, rng=None):
+        self.alphas = np.asarray(alphas, dtype=float)
+        if tail_alpha is None:
+            inner = self.alphas[(self.alphas > 0) & (self.alphas < 1)]
+            tail_alpha = inner.min() if len(inner) else 0
+        self.num_samples = num_samples
+        self.sketch_size = int(sketch_size)
+        self.rng = np.random if rng is None else rng
+        self.count = 0
+        self.total = 0.
+        self.total_squares = 0.
+        self.minimum, self.maximum = np.inf, -np.inf
+        self.exact = (self.alphas == 0) | (self.alphas == 1)
+        self.tail_size = 0
+        tail_alphas = self.alphas[(self.alphas > 0) & (self.alphas <= tail_alpha)]
+        if num_samples is not None and len(tail_alphas):
+            self.exact |= (self.alphas > 0) & (self.alphas <= tail_alpha)
+            # np.quantile interpolates between the sorted returns floor(alpha * (n - 1)) and the next one
+            self.tail_size = int(np.floor(tail_alphas.max() * (num_samples - 1))) + 2
+        # the tail_size lowest returns so far, unsorted, with the chunks added since the last trim pending (up to
+        # tail_size more), plus tail_ties discarded returns equal to tail_threshold, the largest kept return
+        self.tail = np.empty(0)
+        self.tail_threshold = np.inf
+        self.tail_ties = 0
+        self._pending, self._pending_count = [], 0
+        self._sorted_tail = None
+        self.levels = [np.empty(0)]
+
+    def update(self, returns):
+        """ Consumes a chunk of returns. """
+        returns = np.asarray(returns, dtype=float).ravel()
+        if not len(returns):
+            return
+        self.count += len(returns)
+        if self.num_samples is not None and self.count > self.num_samples:
+            raise ValueError('More than the %d announced returns streamed' % self.num_samples)
+        self.total += returns.sum()
+        self.total_squares += (returns ** 2).sum()
+        self.minimum, self.maximum = min(self.minimum, returns.min()), max(self.maximum, returns.max())
+        if self.tail_size:
+            self._add_tail(returns)
+        if not self.exact.all():
+            self._push(0, returns)
+
+    def merge(self, other):
+        """ Adds the returns of another estimator of the same alphas. """
+        if not np.array_equal(self.alphas, other.alphas) or self.tail_size != other.tail_size:
+            raise ValueError('Only estimators of the same alphas and tail can be merged')
+        self.count += other.count
+        self.total += other.total
+        self.total_squares += other.total_squares
+        self.minimum, self.maximum = min(self.minimum, other.minimum), max(self.maximum, other.maximum)
+        if self.tail_size and other.count:
+            other._trim_tail()
+            self._pending.append(other.tail)
+            self._trim_tail((other.tail_threshold, other.tail_ties))
+        for h, level in enumerate(other.levels):
+            self._push(h, level)
+
+    def _add_tail(self, returns):
+        # returns above the threshold can no longer enter the tail, the ones equal to it are ties
+        if np.isfinite(self.tail_threshold):
+            self.tail_ties += int((returns == self.tail_threshold).sum())
+            returns = returns[returns < self.tail_threshold]
+        self._pending.append(returns)
+        self._pending_count += len(returns)
+        self._sorted_tail = None
+        if self._pending_count > self.tail_size:
+            self._trim_tail()
+
+    def _trim_tail(self, *ties):
+        """
+        Keeps the tail_size lowest returns of the buffer (np.partition, no sort). ties are the (threshold, count)
+        of the returns discarded by other full tails merged into the buffer, all at least as large as the kept ones.
+        """
+        if self._pending:
+            self.tail = np.concatenate([self.tail] + self._pending)
+            self._pending, self._pending_count = [], 0
+            self._sorted_tail = None
+        # a tail that never filled up has no threshold, nor any discarded return
+        if len(self.tail) < self.tail_size:
+            return
+        ties += ((self.tail_threshold, self.tail_ties),)
+        tail = np.partition(self.tail, self.tail_size - 1)
+        self.tail, discarded = tail[:self.tail_size], tail[self.tail_size:]
+        self.tail_threshold = self.tail[-1]
+        self.tail_ties = int((discarded == self.tail_threshold).sum()) + sum(
+            n for value, n in ties if value == self.tail_threshold)
+        self._sorted_tail = None
+
+    def _sorted(self):
+        """ The kept lowest returns, sorted once per query after new returns arrived. """
+        self._trim_tail()
+        if self._sorted_tail is None:
+            self._sorted_tail = np.sort(self.tail)
+        return self._sorted_tail
+
+    def _push(self, h, values):
+        while len(self.levels) <= h:
+            self.levels.append(np.empty(0))
+        self.levels[h] = np.concatenate((self.levels[h], values))
+        while len(self.levels[h]) > self.sketch_size:
+            level = np.sort(self.levels[h])
+            # an odd value out stays, so the sketch keeps the total weight of the returns
+            keep = level[-1:] if len(level) % 2 else level[:0]
+            level = level[:len(level) - len(keep)]
+            self.levels[h] = keep
+            self._push(h + 1, level[int(self.rng.random() < 0.5)::2])
+
+    def _exact_tail(self, alpha):
+        tail = self._sorted()
+        position = alpha * (self.count - 1)
+        low = int(np.floor(position))
+        # the sorted returns continue with the ties of the largest kept one
+        low_value, high_value = tail[min(low, len(tail) - 1)], tail[min(low + 1, len(tail) - 1)]
+        var = low_value + (position - low) * (high_value - low_value)
+        below = tail <= var
+        weights = np.ones(below.sum())
+        if var >= tail[-1]:
+            weights[-1] += self.tail_ties
+        return var, tail[below], weights
+
+    def _sketch_tail(self, alpha):
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2. ** h) for h, level in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        values, weights = values[order], weights[order]
+        # the weighted counterpart of np.quantile's interpolation between order statistics
+        position = alpha * (weights.sum() - 1)
+        ranks = np.cumsum(weights) - 1
+        var = np.interp(position, ranks - (weights - 1) / 2, values)
+        below = values <= var
+        return var, values[below], weights[below]
+
+    def _lower_tail(self, i):
+        """ VaR of the i-th alpha and the returns at or below it, with the number of samples each stands for. """
+        alpha = self.alphas[i]
+        if alpha == 0:
+            return self.minimum, np.array([self.minimum]), np.ones(1)
+        return self._exact_tail(alpha) if self.exact[i] else self._sketch_tail(alpha)
+
+    def estimates(self):
+        """
+        Returns:
+        tuple: (VaR, CVaR) arrays, one entry per alpha.
+        """
+        var, cvar = np.zeros(len(self.alphas)), np.zeros(len(self.alphas))
+        for i, alpha in enumerate(self.alphas):
+            if alpha == 1:
+                var[i], cvar[i] = self.maximum, self.total / self.count
+            else:
+                var[i], values, weights = self._lower_tail(i)
+                cvar[i] = np.average(values, weights=weights)
+        return var, cvar
+
+    def intervals(self, confidence=0.95):
+        """
+        Half-widths of asymptotic confidence intervals of the CVaR estimates.
+
+        The CVaR estimate is asymptotically normal around CVaR_alpha with variance
+        Var((X - VaR_alpha) * 1{X <= VaR_alpha}) / (alpha^2 n), estimated from the lower tail (the variance of the
+        returns for alpha = 1). The minimum (alpha = 0) has no such interval, its half-width is NaN.
+
+        Parameters:
+        confidence (float, optional): The confidence level. Defaults to 0.95.
+
+        Returns:
+        np.array: One half-width per alpha.
+        """
+        z = norm.ppf((1 + confidence) / 2)
+        variances = np.full(len(self.alphas), np.nan)
+        for i, alpha in enumerate(self.alphas):
+            if alpha == 1:
+                variances[i] = self.total_squares / self.count - (self.total / self.count) ** 2
+            elif alpha > 0:
+                var, values, weights = self._lower_tail(i)
+                shortfall = values - var
+                variances[i] = ((weights * shortfall ** 2).sum() / self.count
+                                - ((weights * shortfall).sum() / self.count) ** 2) / alpha ** 2
+        return z * np.sqrt(np.maximum(variances, 0) / self.count)
+
+    def std(self):
+        """ Standard deviation of the returns (np.std of all of them). """
+        return np.sqrt(max(self.total_squares / self.count - (self.total / self.count) ** 2, 0))
+
+    def memory(self):
+        """ Number of returns held, up to twice the tail between trims. """
+        return len(self.tail) + self._pending_count + sum(len(level) for level in self.levels)
@@ -1,6 +1,8 @@
 import numpy as np
 from joblib import delayed, Parallel
 
+from algorithms.cvar_estimation import StreamingCvar
+from algorithms.rollouts import batch_returns, stream_returns
 from environments.simple_env import SimpleEnv, State
 
 
@@ -16,12 +18,71 @@ def get_return(env, policy, gamma):
         state = t.state
     return ret
 
-def policy_eval_montecarlo(alphas, policy, gamma, env, num_samples=1000):
-    s = np.array(Parallel(n_jobs=-1, verbose=False)(delayed(get_return)(env, policy, gamma) for _ in range(num_samples)))
+def policy_eval_montecarlo(alphas, policy, gamma, env, num_samples=1000, batched=True, streaming=False):
+    if streaming:
+        # one pass over the batches, holding the lower tail and a quantile sketch instead of every return
+        estimator = StreamingCvar(alphas, num_samples)
+        for returns in stream_returns(env, policy, gamma, num_samples):
+            estimator.update(returns)
+        return list(estimator.estimates()[1])
+    if batched:
+        s = batch_returns(env, policy, gamma, num_samples)
+    else:
+        s = np.array(Parallel(n_jobs=-1, verbose=False)(delayed(get_return)(env, policy, gamma) for _ in range(num_samples)))
     s.sort()
     values = []
     for alpha in alphas:
         cvar = np.mean(s[s <= np.quantile(s, alpha)])
         values.append(cvar)
 
-    return values
\ No newline at end of file
+    return values
+
+def sequential_policy_eval_montecarlo(alphas, policy, gamma, env, width=0.1, max_samples=10 ** 7, batch_size=100000,
+                                      confidence=0.95, min_tail=30):
+    """
+    Monte Carlo CVaR evaluation that samples in batches until every CVaR estimate is known within width.
+
+    After each batch the asymptotic confidence intervals of the estimates are updated (see
+    StreamingCvar.intervals), and the sampling stops once every interval is narrower than width, or after
+    max_samples trajectories. An alpha only counts once min_tail samples fall below its VaR, so that its interval
+    is not trusted on a handful of returns. The minimum (alpha = 0) has no interval and does not hold the sampling.
+    The small alphas set the number of samples, the sample count at which each alpha first met the width is
+    printed.
+
+    Parameters:
+    alphas (np.array): The alpha atoms.
+    policy: The policy to evaluate, see rollouts.policy_matrix.
+    gamma (float): The discount factor.
+    env: The environment, or its compiled TransitionTensor.
+    width (float, optional): Target width of the confidence intervals. Defaults to 0.1.
+    max_samples (int, optional): Sample budget. Defaults to 10 ** 7.
+    batch_size (int, optional): Trajectories per batch. Defaults to 100000.
+    confidence (float, optional): Confidence level of the intervals. Defaults to 0.95.
+    min_tail (int, optional): Samples needed below the VaR of an alpha before its interval counts. Defaults to 30.
+
+    Returns:
+    tuple: (values, half_widths, num_samples): the CVaR estimates, the half-widths of their intervals and the
+        number of trajectories sampled.
+    """
+    alphas = np.asarray(alphas, dtype=float)
+    estimator = StreamingCvar(alphas, max_samples)
+    needed = np.full(len(alphas), -1)
+    pending = alphas > 0
+    for returns in stream_returns(env, policy, gamma, max_samples, batch_size):
+        estimator.update(returns)
+        half_widths = estimator.intervals(confidence)
+        met = pending & (2 * half_widths < width) & (alphas * estimator.count >= min_tail)
+        needed[met & (needed < 0)] = estimator.count
+        if pending.any():
+            widest = np.nanargmax(np.where(pending, half_widths, np.nan))
+            print('Samples:{}, widest interval={} (alpha={})'.format(estimator.count, 2 * half_widths[widest],
+                                                                     alphas[widest]))
+        if (met | ~pending).all():
+            print("intervals narrower than %g after %d samples" % (width, estimator.count))
+            break
+    else:
+        print("sample budget of %d exhausted, widest interval %g" % (max_samples, 2 * np.nanmax(half_widths)))
+
+    for alpha, samples in zip(alphas[pending], needed[pending]):
+        print('alpha={:.4f}: {}'.format(alpha, samples if samples >= 0 else 'not reached'))
+    return estimator.estimates()[1], half_widths, estimator.count
@@ -0,0 +1,85 @@
+import copy
+
+import numpy as np
+
+from algorithms import cvar_value_iteration
+from algorithms.cvar_backends import make_backend
+from algorithms.transition_tensor import compile_world, expand_states, restrict_actions
+from algorithms.utils import AlphaFixedPolicy
+
+
+# IMPLEMENTATION OF (MODIFIED) POLICY ITERATION FOR THE CVAR DECOMPOSITION
+
+def cvar_policy_iteration(world, max_iters=1e3, eps_convergence=1e-3, alphas=None, evaluation_sweeps=20, n_jobs=1,
+                          chunk_size=None, engine='cplex', engine_options=None, fallback=(),
+                          evaluation_engine='closed_form'):
+    """
+    CVaR policy iteration over the per-alpha policy Pol of cvar_value_iteration.
+
+    Each iteration evaluates the current policy with evaluation_sweeps cheap sweeps (or until they converge if
+    evaluation_sweeps is None), then runs one improvement sweep, the max over all actions of cvar_value_iteration.
+    The evaluation sweeps back up only the actions the policy takes in some alpha atom of the state
+    (restrict_actions), and keep the best of them per atom. They run on evaluation_engine, by default the
+    vectorized closed-form backup, which is the optimum of the LPs of the other engines as long as alpha * V(alpha)
+    is convex; only the improvement sweeps solve LPs. Backing up only the single action of every atom instead
+    can break the convexity in alpha of alpha * V(alpha) that the chord constraints of the LP backends rely on (see
+    cvar_backup.cvar_closed_form_backup), and the sweeps then diverge. The run stops when an improvement sweep
+    changes V by less than eps_convergence, the stopping rule of cvar_value_iteration.
+
+    Parameters:
+    world: The environment, or its compiled TransitionTensor.
+    max_iters (int, optional): Largest number of improvement steps. Defaults to 1e3.
+    eps_convergence (float, optional): Threshold on the change of an improvement sweep. Defaults to 1e-3.
+    alphas (np.array): The alpha atoms.
+    evaluation_sweeps (int, optional): Evaluation sweeps between improvements, None to evaluate until convergence.
+        Defaults to 20.
+    engine (str | CvarBackend, optional): Backup backend, see cvar_backends.BACKENDS. Defaults to 'cplex'.
+    evaluation_engine (str | CvarBackend, optional): Backup backend of the evaluation sweeps. Defaults to
+        'closed_form'.
+
+    Returns:
+    tuple: (V, Pol) as returned by cvar_value_iteration.
+    """
+    world = compile_world(world)
+    engine = make_backend(engine, fallback, **(engine_options or {}))
+    V = np.zeros((len(alphas), world.Ns))
+    Pol = np.zeros_like(V, dtype=int)
+    Y_set_all = np.ones((world.Ns, 1)) * alphas
+    discount = 0.95
+    options = dict(discount=discount, n_jobs=n_jobs, chunk_size=chunk_size, engine=engine)
+    evaluation_options = dict(options, engine=make_backend(evaluation_engine))
+
+    V, Pol = cvar_value_iteration.cvar_value_update(world, V, Pol, 0, Y_set_all, **options)
+    i = 0
+    total_evaluation_sweeps = 0
+    while True:
+        policy = AlphaFixedPolicy(world, Pol)
+        evaluation_world = restrict_actions(world, policy.policy.any(axis=0).astype(bool))
+        sweep = 0
+        while evaluation_sweeps is None or sweep < evaluation_sweeps:
+            V_prev = copy.deepcopy(V)
+            V, _ = cvar_value_iteration.cvar_value_update(evaluation_world, V, Pol.copy(), sweep, Y_set_all,
+                                                          **evaluation_options)
+            sweep += 1
+            if np.max(np.abs(V - V_prev)) < eps_convergence or sweep > max_iters:
+                break
+        total_evaluation_sweeps += sweep
+
+        V_prev, Pol_prev = copy.deepcopy(V), Pol.copy()
+        V, Pol = cvar_value_iteration.cvar_value_update(world, V, Pol, i, Y_set_all, **options)
+        error = np.max(np.abs(V - V_prev))
+        print('Iteration:{}, error={}, evaluation sweeps={}, policy changes={}'.format(
+            i, error, sweep, int((Pol != Pol_prev).sum())))
+        if error < eps_convergence:
+            print("value fully learned after %d iterations (%d evaluation sweeps)" % (i, total_evaluation_sweeps))
+            print('Error:', error)
+            break
+        elif i > max_iters:
+            print("value finished without convergence after %d iterations" % (i,))
+            break
+        i += 1
+
+    if engine.report():
+        print(engine.report())
+
+    return expand_states(world, V, Pol)
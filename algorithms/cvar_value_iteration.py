@@ -2,9 +2,13 @@ import copy
 import pickle
 
 import numpy as np
-from pulp import LpProblem, LpVariable, LpMinimize, LpStatusOptimal, LpStatus, CPLEX_PY
-from tqdm import tqdm
 
+from algorithms.alpha_grid import candidate_atoms, interpolate_values
+from algorithms.cvar_backends import cvar_backups, cvar_in_place_backups, make_backend
+from algorithms.error_bound import describe_settings, plan_settings
+from algorithms.prioritized_sweeping import prioritized_sweeping
+from algorithms.stopping import acyclic_layers, run_sweeps
+from algorithms.transition_tensor import compile_world, expand_states, sweep_order
 from environments.autonomous_car import AutonomousCarNavigation
 from environments.cliffwalker import GridWorld
 
@@ -34,67 +38,6 @@ def get_transition_information(action_transitions):
     return np.array(transitions_ids), np.array(transitions_probabilities), np.array(transitions_rewards)
 
 
-def solve_problem(solver):
-    """
-    Solves the optimization problem using the provided solver.
-
-    Parameters:
-    solver (LpProblem): An instance of the PuLP LpProblem class used to define and solve the optimization problem.
-
-    Returns:
-    tuple: A tuple containing two numpy arrays:
-        - solved_xi (np.array): Array of solution values for variables starting with 'xi'.
-        - solved_t (np.array): Array of solution values for variables starting with 't'.
-
-    Raises:
-    SystemExit: If no optimal solution is found.
-    """
-    solver.solve(CPLEX_PY(msg=False))
-    if solver.status == LpStatusOptimal:
-        solved_xi = []
-        solved_t = []
-        solved_xi_names = []
-        solved_t_names = []
-        for v in solver.variables():
-            if v.name.startswith('xi'):
-                solved_xi.append(v.varValue)
-                solved_xi_names.append(v.name)
-            elif v.name.startswith('t'):
-                solved_t.append(v.varValue)
-                solved_t_names.append(v.name)
-
-        # Sort t values by their original order
-        solved_t = [t for _, t in sorted(zip(solved_t_names, solved_t), key=lambda x: int(x[0].split('_')[1]))]
-        solved_xi = [t for _, t in sorted(zip(solved_xi_names, solved_xi), key=lambda x: int(x[0].split('_')[1]))]
-        return np.array(solved_xi), np.array(solved_t)
-    else:
-        print('No optimal solution found')
-        print("STATUS:", LpStatus[solver.status])
-        exit(1)
-
-
-def create_decision_variables(prefix, n_vars, bounds=None, start_index=0):
-    """
-    Create an array of decision variables with consistent naming and bounds.
-
-    Parameters:
-        prefix: String prefix for variable names (e.g., 'xi', 't')
-        n_vars: Number of variables to create
-        bounds: Tuple of (lower_bound, upper_bound) or None for default bounds
-        start_index: Starting index for variable naming
-
-    Returns:
-        array of decision variables, next available index
-    """
-
-    variables = np.array([
-        LpVariable(f'{prefix}_{i + start_index}', lowBound=bounds[0], upBound=bounds[1])
-        for i in range(n_vars)
-    ])
-
-    return variables, start_index + n_vars
-
-
 def get_deterministic_reward(transitions):
     rewards = []
     for action_transitions in transitions:
@@ -105,130 +48,296 @@ def get_deterministic_reward(transitions):
     return np.array(rewards)
 
 
-def dynamic_reshape(arr, n_trans_list, num_alpha):
-    # Calculate cumulative sizes for splitting
-    split_indices = np.cumsum([0] + [(num_alpha - 1) * n for n in n_trans_list])
+def greedy_values(Q):
+    """
+    Picks the best action per state and alpha.
 
-    # Split the array based on n_trans_list
-    split_arrays = np.split(arr, split_indices[1:-1])
+    Parameters:
+    Q (np.array): Q-values of shape (states, actions, alphas).
 
-    # Reshape each split array
-    reshaped_arrays = [arr_split.reshape(num_alpha - 1, n_trans)
-                       for arr_split, n_trans in zip(split_arrays, n_trans_list)]
-    return reshaped_arrays
+    Returns:
+    tuple: (actions, values), both of shape (alphas, states).
+    """
+    actions = np.argmax(Q, axis=1)
+    return actions.T, np.take_along_axis(Q, actions[:, None, :], axis=1)[:, 0, :].T
 
 
-def cvar_value_update(world, V, Pol, id=0, alpha_set_all=None, discount=0.95):
+def cvar_value_update(world, V, Pol, id=0, alpha_set_all=None, discount=0.95, n_jobs=1, chunk_size=None, engine='cplex',
+                      sweep='jacobi', order=None, atoms=None):
     """
     Updates the value function for the given world.
 
+    With sweep='jacobi' every state is backed up from a copy of V taken at the start of the sweep. With
+    sweep='gauss_seidel' states are backed up in the given order and V is updated in place, so later states already
+    use the new values of the earlier ones; this sweep runs serially. With sweep='backward' order holds the layers
+    of an acyclic world (transition_tensor.topological_layers): each layer is backed up at once from the values of
+    the layers before it, which gives the exact values in one sweep.
+
     Parameters:
-    world (GridWorld): The grid world environment.
+    world (GridWorld): The grid world environment, or its compiled TransitionTensor.
     V (np.array): The current value function.
     id (int, optional): The iteration id for progress display. Defaults to 0.
     alpha_set_all (np.array, optional): Array of alpha values for each state. Defaults to None.
     discount (float, optional): The discount factor for future rewards. Defaults to 0.95.
+    n_jobs (int, optional): Number of worker processes for the per-state LPs, -1 for all cores. Defaults to 1.
+    chunk_size (int, optional): States per worker task or closed-form batch. Defaults to None (automatic).
+    engine (str | CvarBackend, optional): Backup backend, see cvar_backends.BACKENDS. Defaults to 'cplex'.
+    sweep (str, optional): 'jacobi', 'gauss_seidel' or 'backward'. Defaults to 'jacobi'.
+    order (str | array, optional): Gauss-Seidel state order, see transition_tensor.sweep_order, or the layers of a
+        backward sweep. Defaults to None.
+    atoms (np.array, optional): Boolean mask of the alpha atoms to update; the others keep their values and policy.
+        Defaults to every atom.
 
     Returns:
     np.array: The updated value function.
     """
-    V_ = copy.deepcopy(V)
-    # np.save('vi_{}.npy'.format(id), V_)
-
-    states = list(world.states())
-    # TODO this loop is parallelizable
-    for s in tqdm(states, desc='Value Update %d' % id):
-        alpha_set = alpha_set_all[s.id]
-        transitions = world.transitions(s)
-        ts = np.array([])
-        solver = LpProblem(name='cvar_value', sense=LpMinimize)
-        objective = np.zeros((len(world.ACTIONS), len(alpha_set)))
-
-        counter = 0
-        n_trans_list = []
-        available_actions = world.actions(s)
-        for a in available_actions:
-            transitions_ids, transitions_probabilities, transitions_rewards = get_transition_information(transitions[a])
-            n_trans = len(transitions_ids)
-            n_trans_list.append(n_trans)
-            for alpha_idx, alpha in enumerate(alpha_set):
-                if alpha == 0:
-                    # when alpha is 0, the cvar is simply the worst case value, so no expectation over some distribution
-                    objective[a, alpha_idx] = min(
-                        (transitions_rewards + discount * V_[alpha_idx, transitions_ids]) * transitions_probabilities)
-                    continue
-
-                # Create xi variables (non-negative)
-                xi, counter = create_decision_variables(
-                    prefix='xi',
-                    n_vars=n_trans,
-                    bounds=(0, None),
-                    start_index=counter
-                )
-                solver += xi @ transitions_probabilities == 1
-
-                t, counter = create_decision_variables(
-                    prefix='t',
-                    n_vars=n_trans,
-                    bounds=(-1e6, 1e6),
-                    start_index=counter
-                )
-                ts = np.append(ts, xi * transitions_probabilities * transitions_rewards + t)
-                for i in range(len(alpha_set) - 1):
-                    alpha_i = alpha_set[i]
-                    alpha_i_next = alpha_set[i + 1]
-                    v_i = V_[i, transitions_ids]
-                    v_i_next = V_[i + 1, transitions_ids]
-                    slope = (alpha_i_next * v_i_next - alpha_i * v_i) / (alpha_i_next - alpha_i)
-
-                    right_ineq = (alpha_i * v_i / alpha - slope * alpha_i / alpha) * discount * transitions_probabilities
-                    left_ineq = t - slope * xi * discount * transitions_probabilities
-                    for idx in range(len(right_ineq)):
-                        solver += left_ineq[idx] >= right_ineq[idx]
-                        solver += xi[idx] <= 1 / alpha
-
-        solver += sum(ts)
-        xi_values, t_values = solve_problem(solver)
-        xi_values = dynamic_reshape(xi_values, n_trans_list, len(alpha_set))
-        t_values = dynamic_reshape(t_values, n_trans_list, len(alpha_set))
-        for idx, a in enumerate(available_actions):
-            _, transitions_probabilities, transitions_rewards = get_transition_information(transitions[a])
-            t_values[idx] = (xi_values[idx] * transitions_rewards * transitions_probabilities + t_values[idx]).sum(-1)
-
-        objective[available_actions, 1:] = np.array(t_values)
-        unavailable_actions = set(range(len(world.ACTIONS))) - set(available_actions)
-        objective[list(unavailable_actions), :] = -np.inf
-        Q = objective
-
-        for alpha_idx2 in range(len(alpha_set)):
-            Pol[alpha_idx2, s.id] = np.argmax(Q[:, alpha_idx2])
-            V[alpha_idx2, s.id] = Q[Pol[alpha_idx2, s.id], alpha_idx2]
+    mdp = compile_world(world)
+    active = np.ones(V.shape[0], dtype=bool) if atoms is None else atoms
+    if sweep == 'gauss_seidel':
+        state_ids = sweep_order(mdp, order)
+        Q = cvar_in_place_backups(mdp, V, alpha_set_all,
+                                  lambda ids, Q_: np.where(active[:, None], greedy_values(Q_)[1], V[:, ids]),
+                                  discount=discount, state_ids=state_ids, chunk_size=chunk_size,
+                                  desc='Value Update %d' % id, engine=engine, atoms=atoms)
+    elif sweep == 'jacobi':
+        V_ = copy.deepcopy(V)
+        # np.save('vi_{}.npy'.format(id), V_)
+        state_ids = mdp.state_ids
+        Q = cvar_backups(mdp, V_, alpha_set_all, discount=discount, state_ids=state_ids, n_jobs=n_jobs,
+                         chunk_size=chunk_size, desc='Value Update %d' % id, engine=engine, atoms=atoms)
+    elif sweep == 'backward':
+        state_ids, Q = np.concatenate(order), []
+        for layer in order:
+            Q.append(cvar_backups(mdp, V, alpha_set_all, discount=discount, state_ids=layer, n_jobs=n_jobs,
+                                  chunk_size=chunk_size, desc='Value Update %d' % id, engine=engine, atoms=atoms))
+            V[np.ix_(active, layer)] = greedy_values(Q[-1])[1][active]
+        Q = np.concatenate(Q)
+    else:
+        raise ValueError("Unknown sweep '%s', expected 'jacobi', 'gauss_seidel' or 'backward'" % sweep)
+
+    # Q is (states, actions, alphas): pick the best action per state and alpha
+    actions, values = greedy_values(Q)
+    Pol[np.ix_(active, state_ids)] = actions[active]
+    V[np.ix_(active, state_ids)] = values[active]
 
     return V, Pol
 
 
-def cvar_value_iteration(world, max_iters=1e3, eps_convergence=1e-3, alphas=None):
-    V = np.zeros((len(alphas), world.Ns))
+def print_residual_report(alphas, history, eps_convergence):
+    """
+    Prints, per alpha atom, the first iteration its residual fell below eps_convergence and its last residual.
+
+    Parameters:
+    alphas (np.array): The alpha atoms.
+    history (np.array): Residual of every atom at every iteration, shape (iterations, Ny).
+    eps_convergence (float): The convergence threshold.
+    """
+    print('alpha        converged at  last residual')
+    for alpha, residuals in zip(alphas, history.T):
+        below = np.flatnonzero(residuals < eps_convergence)
+        print('{:<12.4g} {:<13} {:.3e}'.format(alpha, below[0] if len(below) else '-', residuals[-1]))
+
+
+def cvar_value_iteration(world, max_iters=1e3, eps_convergence=1e-3, alphas=None, n_jobs=1, chunk_size=None,
+                         engine='cplex', engine_options=None, fallback=(), sweep='jacobi', order=None,
+                         freeze_atoms=False, return_history=False, V0=None, acceleration=None, tolerance=None,
+                         return_certificate=False, detect_acyclic=True):
+    """
+    CVaR value iteration. The residual of every alpha atom is tracked per iteration and summarized at the end.
+
+    With freeze_atoms, an atom whose residual falls below eps_convergence is frozen: its values and policy are kept
+    and its blocks are dropped from the backups of the following iterations. Frozen atoms still feed the chords of
+    the other atoms' backups, but do not follow later changes of those atoms, so this trades exactness (bounded by
+    how much the remaining atoms still move) for skipping the LPs of the atoms that settle early.
+
+    V0 (np.array, optional): Initial value function of shape (len(alphas), Ns), e.g. to warm start from another
+        solve. Defaults to zeros.
+    acceleration (str | Accelerator, optional): 'anderson' or 'sor' to extrapolate between sweeps, see
+        acceleration.Accelerator. Defaults to None (plain sweeps).
+    tolerance (float, optional): Requested accuracy of V. The run stops as soon as the certified bounds of the last
+        sweep (stopping.certify) pin every value within tolerance, and returns their midpoint; eps_convergence is
+        then unused. The bounds do not hold for the atoms frozen by freeze_atoms. Defaults to None, the residual rule.
+    detect_acyclic (bool, optional): Solve acyclic worlds (transition_tensor.topological_layers) with a single
+        backward induction sweep, which gives the exact values. Defaults to True.
+
+    Returns:
+    tuple: (V, Pol), plus the (iterations, Ny) residual history if return_history, plus the certificate of the last
+        sweep (see stopping.certify, with the iteration count) if return_certificate.
+    """
+    world = compile_world(world)
+    engine = make_backend(engine, fallback, **(engine_options or {}))
+    order = sweep_order(world, order)
+    layers = acyclic_layers(world, detect_acyclic)
+    if layers is not None:
+        sweep, order = 'backward', layers
+    V = np.zeros((len(alphas), world.Ns)) if V0 is None else np.array(V0, dtype=float)
     Pol = np.zeros_like(V, dtype=int)
     Y_set_all = np.ones((world.Ns, 1)) * alphas
-    i = 0
+    active = np.ones(len(alphas), dtype=bool)
+    history = []
     discount = 0.95
-    while True:
+
+    def update(V, i):
+        nonlocal Pol
         V_prev = copy.deepcopy(V)
-        V_new, Pol = cvar_value_update(world, V, Pol, i, Y_set_all, discount=discount)
-        error = np.max(np.abs(V_new - V_prev))
-        print('Iteration:{}, error={}'.format(i, error))
-        V = V_new
-        if error < eps_convergence:
-            print("value fully learned after %d iterations" % (i,))
-            print('Error:', error)
+        V_new, Pol = cvar_value_update(world, V, Pol, i, Y_set_all, discount=discount, n_jobs=n_jobs,
+                                       chunk_size=chunk_size, engine=engine, sweep=sweep, order=order,
+                                       atoms=None if active.all() else active)
+        residuals = np.max(np.abs(V_new - V_prev), axis=1)
+        history.append(residuals)
+        if freeze_atoms and (active & (residuals < eps_convergence)).any():
+            print('Freezing alpha atoms:', alphas[active & (residuals < eps_convergence)])
+            active[:] &= residuals >= eps_convergence
+        return V_new
+
+    V, certificate = run_sweeps(world, update, V, discount, eps_convergence, max_iters, acceleration, tolerance,
+                                exact=sweep == 'backward')
+    print_residual_report(alphas, np.array(history), eps_convergence)
+    if engine.report():
+        print(engine.report())
+
+    V, Pol = expand_states(world, V, Pol)
+    result = (V, Pol)
+    if return_history:
+        result += (np.array(history),)
+    if return_certificate:
+        result += (certificate,)
+    return result
+
+
+def coarse_to_fine_cvar_value_iteration(world, alphas=None, tolerance=1e-2, max_atoms=51, max_levels=10,
+                                        max_iters=1e3, eps_convergence=1e-3, engine='cplex', engine_options=None,
+                                        fallback=()):
+    """
+    CVaR value iteration on an alpha grid refined where interpolating alpha * V(alpha) is least accurate.
+
+    Each level solves on the current grid, warm started from the previous level's solution interpolated onto it.
+    The interpolation error of every interval is then estimated at its candidate atom (see
+    alpha_grid.candidate_atoms) as the largest change, over all states, of alpha * V(alpha) between the interpolated
+    value and one exact backup at that atom. Candidates whose error exceeds tolerance are inserted, largest first,
+    up to max_atoms. The refinement stops once no candidate exceeds tolerance, or after the solve of level
+    max_levels - 1.
+
+    Parameters:
+    world: The environment, or its compiled TransitionTensor.
+    alphas (np.array, optional): The coarse starting grid, starting at 0. Defaults to 0 and 5 log-spaced atoms.
+    tolerance (float, optional): Target interpolation error of alpha * V(alpha). Defaults to 1e-2.
+    max_atoms (int, optional): Largest grid size. Defaults to 51.
+    max_levels (int, optional): Largest number of refinement levels. Defaults to 10.
+    max_iters (int, optional): Iteration budget of each level. Defaults to 1e3.
+    eps_convergence (float, optional): Convergence threshold of each level. Defaults to 1e-3.
+    engine (str | CvarBackend, optional): Backup backend, see cvar_backends.BACKENDS. Defaults to 'cplex'.
+    engine_options (dict, optional): Options of the backend (time_limit, threads, ...). Defaults to None.
+    fallback (sequence, optional): Backends to fall back to. Defaults to none.
+
+    Returns:
+    tuple: (V, Pol, alphas), the solution and the final grid.
+    """
+    world = compile_world(world)
+    engine = make_backend(engine, fallback, **(engine_options or {}))
+    alphas = np.concatenate(([0], np.logspace(-2, 0, 5))) if alphas is None else np.asarray(alphas, dtype=float)
+    discount = 0.95
+    V0 = None
+    for level in range(max_levels):
+        print('Level {}: {} atoms'.format(level, len(alphas)))
+        V, Pol = cvar_value_iteration(world, max_iters=max_iters, eps_convergence=eps_convergence, alphas=alphas,
+                                      engine=engine, V0=V0)
+        # the unreachable states of a pruned world come back as NaN, keep them out of the next backups
+        V_solved = np.nan_to_num(V)
+        candidates = candidate_atoms(alphas)
+        # the last level is not refined, so the returned V and Pol are solved on the returned grid
+        if len(alphas) >= max_atoms or not len(candidates) or level == max_levels - 1:
             break
-        elif i > max_iters:
-            print("value finished without convergence after %d iterations" % (i,))
+
+        fine = np.union1d(alphas, candidates)
+        V_fine = interpolate_values(V_solved, alphas, fine)
+        V_backup, _ = cvar_value_update(world, V_fine.copy(), np.zeros_like(V_fine, dtype=int), level,
+                                        np.ones((world.Ns, 1)) * fine, discount=discount, engine=engine)
+        at = np.searchsorted(fine, candidates)
+        errors = np.max(np.abs(candidates[:, None] * (V_backup[at] - V_fine[at])), axis=1)
+        print('Level {}: largest interpolation error {} at alpha={}'.format(level, errors.max(),
+                                                                           candidates[np.argmax(errors)]))
+
+        worst_first = np.argsort(-errors)
+        inserted = candidates[worst_first[errors[worst_first] > tolerance][:max_atoms - len(alphas)]]
+        if not len(inserted):
             break
-        i += 1
+        refined = np.union1d(alphas, inserted)
+        V0 = interpolate_values(V_solved, alphas, refined)
+        alphas = refined
 
-    return V, Pol
+    return V, Pol, alphas
+
+
+def prioritized_cvar_value_iteration(world, max_iters=1e3, eps_convergence=1e-3, alphas=None, engine='cplex',
+                                     engine_options=None, fallback=(), batch_size=None):
+    """
+    CVaR value iteration driven by prioritized sweeping: after the first backup of every state, only the states whose
+    successors changed by more than eps_convergence (in any alpha atom) are backed up again, largest change first.
+
+    Parameters:
+    world: The environment, or its compiled TransitionTensor.
+    max_iters (int, optional): Budget in sweep equivalents (max_iters * number of states backups). Defaults to 1e3.
+    eps_convergence (float, optional): Threshold on the pending change of a state. Defaults to 1e-3.
+    alphas (np.array): The alpha atoms.
+    engine (str | CvarBackend, optional): Backup backend, see cvar_backends.BACKENDS. Defaults to 'cplex'.
+    engine_options (dict, optional): Options of the backend (time_limit, threads, ...). Defaults to None.
+    fallback (sequence, optional): Backends to fall back to. Defaults to none.
+    batch_size (int, optional): States backed up together. Defaults to the backend's states_per_batch.
+
+    Returns:
+    tuple: (V, Pol) as returned by cvar_value_iteration.
+    """
+    world = compile_world(world)
+    engine = make_backend(engine, fallback, **(engine_options or {}))
+    V = np.zeros((len(alphas), world.Ns))
+    Pol = np.zeros_like(V, dtype=int)
+    Y_set_all = np.ones((world.Ns, 1)) * alphas
+    discount = 0.95
+
+    def backup(ids):
+        Pol[:, ids], values = greedy_values(engine.backup_states(world, V, Y_set_all, discount, ids))
+        return values
+
+    backups = prioritized_sweeping(world, V, backup, discount, threshold=eps_convergence,
+                                   max_backups=int(max_iters * len(world.state_ids)),
+                                   batch_size=batch_size or engine.states_per_batch)
+    print("value learned with %d backups (%.1f sweep equivalents)" % (backups, backups / len(world.state_ids)))
+
+    if engine.report():
+        print(engine.report())
+
+    return expand_states(world, V, Pol)
+
+
+def planned_cvar_value_iteration(world, target_error, budget=None, alpha_min=1e-2, max_iters=1e3, n_jobs=1,
+                                 chunk_size=None, engine='cplex', engine_options=None, fallback=()):
+    """
+    CVaR value iteration with the alpha grid and eps_convergence chosen by error_bound.plan_settings to meet
+    target_error at the least predicted cost. The first sweep's change is predicted from the largest absolute reward
+    of the world.
+
+    Parameters:
+    world: The environment, or its compiled TransitionTensor.
+    target_error (float): Target bound on the CVaR value error.
+    budget (float, optional): Largest acceptable cost in atom-sweeps. Defaults to no limit.
+    alpha_min (float, optional): Smallest positive atom of the grid. Defaults to 1e-2.
+
+    Returns:
+    tuple: (V, Pol, settings), settings being the plan of plan_settings plus the iterations actually run.
+    """
+    world = compile_world(world)
+    discount = 0.95
+    settings = plan_settings(target_error, budget, gamma=discount, alpha_min=alpha_min,
+                             initial_error=max(np.abs(world.reward).max(initial=0), 1e-12))
+    print('Planned Ny={}, eps_convergence={}, predicted error bound={}'.format(
+        settings['Ny'], settings['eps_convergence'], settings['error_bound']))
+    V, Pol, history = cvar_value_iteration(world, max_iters=max_iters, eps_convergence=settings['eps_convergence'],
+                                           alphas=settings['alphas'], n_jobs=n_jobs, chunk_size=chunk_size,
+                                           engine=engine, engine_options=engine_options, fallback=fallback,
+                                           return_history=True)
+    settings['iterations_run'] = len(history)
+    return V, Pol, settings
 
 
 def main():
@@ -237,14 +346,23 @@ def main():
     MAX_ITERS = 1000
     TOLL = 1e-3
     Ny = 21
+    # set a target CVaR error to let the error bound choose Ny and TOLL instead
+    TARGET_ERROR = None
     alphas = np.concatenate(([0], np.logspace(-2, 0, Ny - 1)))
 
     np.random.seed(2)
     # world = AutonomousCarNavigation()
     world = GridWorld(random_action_p=0.05, path='gridworld4.png')
     if PERFORM_VI:
-        V, Policy = cvar_value_iteration(world, max_iters=MAX_ITERS, eps_convergence=TOLL, alphas=alphas)
+        if TARGET_ERROR is None:
+            V, Policy = cvar_value_iteration(world, max_iters=MAX_ITERS, eps_convergence=TOLL, alphas=alphas)
+            settings = describe_settings(alphas, TOLL)
+        else:
+            V, Policy, settings = planned_cvar_value_iteration(world, TARGET_ERROR, max_iters=MAX_ITERS)
+        alphas = settings['alphas']
         pickle.dump((V, Policy), open('../policies/cvar_vi.pkl', mode='wb'))
+        # the settings and their predicted error bound, next to the results
+        pickle.dump(settings, open('../policies/cvar_vi_settings.pkl', mode='wb'))
 
     V, Policy = pickle.load(open('../policies/cvar_vi.pkl', mode='rb'))
     for idx, alpha in enumerate(alphas):
@@ -0,0 +1,91 @@
+import numpy as np
+
+# IMPLEMENTATION OF THE CVAR VALUE ITERATION ERROR BOUND AND OF THE PLANNING OF ITS ALPHA GRID AND TOLERANCE
+
+
+def log_grid(Ny, alpha_min=1e-2):
+    """ The alpha grid of the drivers: 0 followed by Ny - 1 log-spaced atoms from alpha_min to 1. """
+    return np.concatenate(([0], np.logspace(np.log10(alpha_min), 0, Ny - 1)))
+
+
+def get_theta(atoms):
+    # Calculate theta: the largest ratio between consecutive points (constant for log-spacing), avoiding the zero element
+    positive = atoms[atoms > 0]
+    theta = np.max(positive[1:] / positive[:-1])
+    return theta
+
+
+def get_error_bound(theta, epsilon, gamma=0.95):
+    return (gamma / (1 - gamma)) * ((theta - 1) + epsilon)
+
+
+def get_iterations(epsilon, gamma=0.95, initial_error=1.0):
+    """
+    Predicted number of value iteration sweeps, starting from V = 0, until the change of a sweep falls below epsilon.
+
+    Parameters:
+    epsilon (float): The eps_convergence of the run.
+    gamma (float, optional): The discount factor. Defaults to 0.95.
+    initial_error (float, optional): The change of the first sweep, i.e. the largest absolute reward. Defaults to 1.
+
+    Returns:
+    int: The number of sweeps.
+    """
+    return max(1, int(np.ceil(np.log(epsilon / initial_error) / np.log(gamma))))
+
+
+def describe_settings(atoms, epsilon, gamma=0.95, initial_error=1.0):
+    """
+    The record of a CVaR value iteration setting: grid, tolerance, predicted error bound and predicted cost.
+
+    Returns:
+    dict: Ny, alpha_min, alphas, theta, eps_convergence, gamma, error_bound, iterations and cost (in atom-sweeps,
+        i.e. Ny * iterations; the cost of a sweep grows linearly with the number of atoms).
+    """
+    theta = get_theta(atoms)
+    iterations = get_iterations(epsilon, gamma, initial_error)
+    return {'Ny': len(atoms), 'alpha_min': float(atoms[atoms > 0].min()), 'alphas': np.array(atoms),
+            'theta': float(theta), 'eps_convergence': float(epsilon), 'gamma': gamma,
+            'error_bound': float(get_error_bound(theta, epsilon, gamma)), 'iterations': iterations,
+            'cost': len(atoms) * iterations}
+
+
+def plan_settings(target_error, budget=None, gamma=0.95, alpha_min=1e-2, initial_error=1.0, max_Ny=2001):
+    """
+    Chooses the log-spaced alpha grid and the eps_convergence that meet a target CVaR error bound at the least
+    predicted cost.
+
+    The bound gamma / (1 - gamma) * ((theta - 1) + epsilon) splits the target between the grid (theta) and the
+    value iteration tolerance (epsilon). For every Ny the grid fixes theta and the remaining slack goes to epsilon,
+    the largest tolerance that still meets the target; the cheapest of these (Ny, epsilon) pairs is chosen.
+
+    Parameters:
+    target_error (float): Target bound on the CVaR value error.
+    budget (float, optional): Largest acceptable cost in atom-sweeps. Defaults to no limit.
+    gamma (float, optional): The discount factor. Defaults to 0.95.
+    alpha_min (float, optional): Smallest positive atom of the grid. Defaults to 1e-2.
+    initial_error (float, optional): The largest absolute reward, see get_iterations. Defaults to 1.
+    max_Ny (int, optional): Largest grid considered. Defaults to 2001.
+
+    Returns:
+    dict: The chosen settings, see describe_settings.
+
+    Raises:
+    ValueError: If no grid up to max_Ny meets the target, or the cheapest one exceeds the budget.
+    """
+    best = None
+    for n in range(3, max_Ny + 1):
+        atoms = log_grid(n, alpha_min)
+        slack = target_error * (1 - gamma) / gamma - (get_theta(atoms) - 1)
+        if slack <= 0:
+            continue
+        settings = describe_settings(atoms, slack, gamma, initial_error)
+        if best is None or settings['cost'] < best['cost']:
+            best = settings
+
+    if best is None:
+        raise ValueError("No grid of up to %d atoms meets a target error of %g" % (max_Ny, target_error))
+    if budget is not None and best['cost'] > budget:
+        raise ValueError("A target error of %g needs at least %d atom-sweeps (Ny=%d, eps_convergence=%g), "
+                         "the budget is %d" % (target_error, best['cost'], best['Ny'], best['eps_convergence'], budget))
+    return best
@@ -0,0 +1,77 @@
+import heapq
+
+import numpy as np
+
+# IMPLEMENTATION OF A PRIORITIZED SWEEPING SCHEDULER SHARED BY THE STANDARD AND THE CVAR VALUE ITERATION
+
+
+def prioritized_sweeping(mdp, V, backup, discount, threshold=1e-3, max_backups=None, batch_size=1, report_every=None):
+    """
+    Backs up only the states whose successors moved, largest pending change first.
+
+    Every state starts in the queue. Backing up a state that changes by delta can change the backup of each of its
+    predecessors (found with mdp.predecessors()) by at most discount * delta. These bounds are accumulated in the
+    pending change of every predecessor, reset when it is backed up, and a predecessor is queued once its pending
+    change exceeds threshold. The pending change bounds how much a backup would move the state, so the run ends,
+    when no state has a pending change above threshold, with the same guarantee as a sweep whose largest change is
+    below threshold.
+
+    Parameters:
+    mdp (TransitionTensor): The compiled world.
+    V (np.array): The value function, shape (Ns,) or (Ny, Ns), updated in place.
+    backup (callable): Maps an array of state ids to their new values, shaped like V[..., ids]. It may update
+        other per-state data (e.g. the policy) as a side effect.
+    discount (float): The discount factor, i.e. the contraction factor of the backup.
+    threshold (float, optional): Smallest pending change worth a backup. Defaults to 1e-3.
+    max_backups (int, optional): Budget of state backups. Defaults to no limit.
+    batch_size (int, optional): States popped and backed up together. Defaults to 1.
+    report_every (int, optional): Print progress every that many backups. Defaults to once per Ns backups.
+
+    Returns:
+    int: The number of state backups performed.
+    """
+    pred_indptr, pred_ids = mdp.predecessors()
+    enumerated = np.zeros(mdp.Ns, dtype=bool)
+    enumerated[mdp.state_ids] = True
+    report_every = report_every or len(mdp.state_ids)
+
+    priority = np.zeros(mdp.Ns)
+    priority[mdp.state_ids] = np.inf
+    queue = [(-np.inf, int(s)) for s in mdp.state_ids]
+    heapq.heapify(queue)
+
+    backups = 0
+    next_report = report_every
+    while queue and (max_backups is None or backups < max_backups):
+        ids = []
+        while queue and len(ids) < batch_size:
+            neg_priority, s = heapq.heappop(queue)
+            # skip entries superseded by a later push or already served
+            if -neg_priority == priority[s] and priority[s] > threshold:
+                ids.append(s)
+                priority[s] = 0
+        if not ids:
+            break
+
+        ids = np.array(ids)
+        new_values = backup(ids)
+        delta = np.abs(new_values - V[..., ids]).reshape(-1, len(ids)).max(axis=0)
+        V[..., ids] = new_values
+        backups += len(ids)
+
+        for s, d in zip(ids, delta):
+            if d == 0:
+                continue
+            for p in pred_ids[pred_indptr[s]:pred_indptr[s + 1]]:
+                if enumerated[p]:
+                    # small changes of several successors, or repeated ones, add up to a backup worth doing
+                    priority[p] += discount * d
+                    if priority[p] > threshold:
+                        heapq.heappush(queue, (-priority[p], int(p)))
+
+        if backups >= next_report:
+            print('Backups:{}, queued={}, max pending change={}'.format(backups, int((priority > threshold).sum()),
+                                                                      priority.max()))
+            next_report += report_every
+
+    return backups
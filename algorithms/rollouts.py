@@ -0,0 +1,96 @@
+import numpy as np
+
+from algorithms.transition_tensor import compile_world
+
+# IMPLEMENTATION OF BATCHED MONTE CARLO ROLLOUTS OVER THE COMPILED TRANSITION STRUCTURE
+
+
+def policy_matrix(world, policy):
+    """
+    The (Ns, Na) action probabilities of a policy.
+
+    Parameters:
+    world: The environment, or its compiled TransitionTensor.
+    policy: A Policy of algorithms.utils with a policy array (ProbabilisticPolicy, FixedPolicy), a RandomPolicy
+        (uniform over the actions), an (Ns, Na) array of action probabilities or an (Ns,) array of actions.
+
+    Returns:
+    np.array: Row-stochastic action probabilities of shape (Ns, Na).
+    """
+    Na = len(world.ACTIONS)
+    if hasattr(policy, 'env'):
+        if not hasattr(policy, 'policy'):
+            return np.ones((world.Ns, Na)) / Na
+        policy = policy.policy
+    policy = np.asarray(policy)
+    if policy.ndim == 1:
+        return np.eye(Na)[policy]
+    return policy / np.maximum(policy.sum(axis=1, keepdims=True), 1e-300)
+
+
+def sample_rows(cdf, u):
+    """ Inverse-CDF sampling: the column of every row of the (B, K) cumulative weights cdf hit by u * its total. """
+    k = (cdf <= (u * cdf[:, -1])[:, None]).sum(axis=1)
+    return np.minimum(k, cdf.shape[1] - 1)
+
+
+def batch_returns(world, policy, gamma, num_samples=1000, batch_size=100000, max_steps=None, rng=None):
+    """
+    Discounted returns of num_samples trajectories from the initial state, simulated batch_size at a time.
+    See stream_returns for the parameters.
+
+    Returns:
+    np.array: The num_samples discounted returns.
+    """
+    return np.concatenate(list(stream_returns(world, policy, gamma, num_samples, batch_size, max_steps, rng)))
+
+
+def stream_returns(world, policy, gamma, num_samples=1000, batch_size=100000, max_steps=None, rng=None):
+    """
+    Discounted returns of num_samples trajectories from the initial state, yielded batch_size at a time.
+
+    The trajectories of a batch advance together as an array of state ids: actions and successors are drawn by
+    inverse-CDF sampling from the cumulative action probabilities and the padded transition rows of the compiled
+    world, and a trajectory stops on a terminal or goal state (or a state without successors). It replaces the
+    per-trajectory loop of get_return (cvar_policy_eval_montecarlo), with the same distribution of returns.
+
+    Parameters:
+    world: The environment, or its compiled TransitionTensor.
+    policy: The policy to simulate, see policy_matrix.
+    gamma (float): The discount factor.
+    num_samples (int, optional): Number of trajectories. Defaults to 1000.
+    batch_size (int, optional): Number of trajectories simulated at once, to bound the memory. Defaults to 100000.
+    max_steps (int, optional): Truncate the trajectories after max_steps steps. Defaults to None (no limit).
+    rng (np.random.Generator, optional): The random generator. Defaults to the global numpy state, so
+        np.random.seed makes the returns reproducible.
+
+    Yields:
+    np.array: The discounted returns of a batch.
+    """
+    mdp = compile_world(world)
+    rng = np.random if rng is None else rng
+    next_ids, probs, rewards = mdp.padded()
+    next_ids, rewards = next_ids.reshape(mdp.Ns * mdp.Na, -1), rewards.reshape(mdp.Ns * mdp.Na, -1)
+    transition_cdf = np.cumsum(probs.reshape(mdp.Ns * mdp.Na, -1), axis=1)
+    action_cdf = np.cumsum(policy_matrix(mdp, policy), axis=1)
+    stop = mdp.terminal_mask.copy()
+    stop[mdp.goal_ids] = True
+
+    for start in range(0, num_samples, batch_size):
+        returns = np.zeros(min(batch_size, num_samples - start))
+        active = np.arange(len(returns))
+        states = np.full(len(active), mdp.initial_state.id, dtype=np.int64)
+        keep = ~stop[states]
+        active, states = active[keep], states[keep]
+        step = 0
+        while len(active) and (max_steps is None or step < max_steps):
+            actions = sample_rows(action_cdf[states], rng.random(len(active)))
+            rows = states * mdp.Na + actions
+            cdf = transition_cdf[rows]
+            k = sample_rows(cdf, rng.random(len(active)))
+            returns[active] += gamma ** step * rewards[rows, k]
+            states = next_ids[rows, k]
+            step += 1
+            keep = ~stop[states] & (cdf[:, -1] > 0)
+            active, states = active[keep], states[keep]
+        yield returns
@@ -1,49 +1,108 @@
-import copy
-
 import numpy as np
+from scipy.sparse import csr_matrix, identity
+from scipy.sparse.linalg import bicgstab, gmres, spsolve
+
+from algorithms.stopping import acyclic_layers, certify, report_certificate, run_sweeps
+from algorithms.transition_tensor import check_lumped_policy, compile_world, expand_states, policy_mixture, q_values
 
-def value_update(world, V, Pol, i, discount):
-    V_ = copy.deepcopy(V)
-    for s in world.states():
-        q_values = np.full(len(world.ACTIONS), -np.inf)
-        available_actions = world.actions(s)
-        for a in available_actions:
-            Q = 0
-            for t in world.transitions(s)[a]:
-                Q += t.prob * (t.reward + discount * V_[t.state.id])
-            q_values[a] = Q
-
-        policy_probs = Pol.policy[s.id]
-        if policy_probs.dtype == np.int64:
-            boolean_probs = policy_probs == 1
-            q_values = q_values[boolean_probs]
-            V[s.id] = q_values[0]
-        else:
-            policy_probs = policy_probs[policy_probs != 0]
-            q_values = q_values[q_values != -np.inf]
-            V[s.id] = (policy_probs * np.array(q_values)).sum()
+
+def value_update(world, V, Pol, i, discount, layers=None):
+    mdp = compile_world(world)
+    V = V.copy()
+    # a backward induction sweep backs up the layers in turn, each from the values of the layers before it
+    for ids in [mdp.state_ids] if layers is None else layers:
+        V[ids] = policy_mixture(Pol.policy[ids], q_values(mdp, V, discount, ids))
 
     return V
 
 
-def policy_evaluation_standard(world, max_iters=1e3, eps_convergence=1e-3, Pol=None, discount=0.95):
+def policy_transition_matrix(world, policy_probs):
+    """
+    Builds the transition matrix and expected reward vector of the Markov chain induced by a policy.
+
+    Parameters:
+    world (TransitionTensor): The compiled world.
+    policy_probs (np.array): Action probabilities per state, shape (Ns, Na).
+
+    Returns:
+    tuple: A tuple containing:
+        - P_pi (scipy.sparse.csr_matrix): Transition matrix of shape (Ns, Ns).
+        - r_pi (np.array): Expected one-step reward per state, shape (Ns,).
+    """
+    counts = np.diff(world.indptr)
+    rows = np.repeat(np.arange(world.Ns * world.Na), counts)
+    states, actions = np.divmod(rows, world.Na)
+    weights = np.where(world.action_mask[states, actions], policy_probs[states, actions], 0) * world.prob
+    P_pi = csr_matrix((weights, (states, world.next_id)), shape=(world.Ns, world.Ns))
+    r_pi = np.bincount(states, weights=weights * world.reward, minlength=world.Ns)
+    return P_pi, r_pi
+
+
+def policy_evaluation_linear(world, Pol, discount=0.95, method='direct', eps_convergence=1e-10):
+    """
+    Evaluates a policy exactly by solving (I - discount * P_pi) V = r_pi.
+
+    Parameters:
+    world (TransitionTensor): The compiled world.
+    Pol (Policy): A policy exposing a (Ns, Na) 'policy' array (FixedPolicy, ProbabilisticPolicy).
+    discount (float, optional): The discount factor for future rewards. Defaults to 0.95.
+    method (str, optional): 'direct' for a sparse LU solve, 'gmres' or 'bicgstab' for a Krylov solve. Defaults to 'direct'.
+    eps_convergence (float, optional): Relative residual tolerance of the Krylov solvers. Defaults to 1e-10.
+
+    Returns:
+    np.array: The value function.
+    """
+    P_pi, r_pi = policy_transition_matrix(world, Pol.policy)
+    A = (identity(world.Ns, format='csr') - discount * P_pi).tocsc()
+    if method == 'direct':
+        V = spsolve(A, r_pi)
+    elif method in ('gmres', 'bicgstab'):
+        krylov = gmres if method == 'gmres' else bicgstab
+        V, info = krylov(A, r_pi, rtol=eps_convergence, atol=0.)
+        if info != 0:
+            print("%s finished without convergence (info=%d)" % (method, info))
+    else:
+        raise ValueError("Unknown method '%s', expected 'iterative', 'direct', 'gmres' or 'bicgstab'" % method)
+    print("value solved with method '%s'" % method)
+    return np.asarray(V)
+
+
+def policy_evaluation_standard(world, max_iters=1e3, eps_convergence=1e-3, Pol=None, discount=0.95, method='iterative',
+                               acceleration=None, tolerance=None, return_certificate=False, detect_acyclic=True):
+    """
+    Evaluates a policy under the expected return.
+
+    With method='iterative' this runs fixed-point iteration until the max-norm change drops below
+    eps_convergence, optionally accelerated ('anderson' or 'sor', see acceleration.Accelerator), or with a tolerance
+    until the certified bounds of the last sweep (stopping.certify) pin every value within tolerance, returning
+    their midpoint. An acyclic world (transition_tensor.topological_layers) is solved exactly by a single backward
+    induction sweep instead, unless detect_acyclic is False. Any other method solves the linear system exactly
+    (see policy_evaluation_linear); its certificate comes from one extra sweep of the solution.
+
+    Returns:
+    np.array: V, plus the certificate of the last sweep (see stopping.certify) if return_certificate.
+    """
+    world = compile_world(world)
+    check_lumped_policy(world, Pol.policy)
+    if method != 'iterative':
+        V = policy_evaluation_linear(world, Pol, discount=discount, method=method)
+        if return_certificate:
+            certificate = certify(world, V, value_update(world, V, Pol, 0, discount), discount)
+            report_certificate(certificate, V, 0)
+            return expand_states(world, V)[0], certificate
+        return expand_states(world, V)[0]
+
+    layers = acyclic_layers(world, detect_acyclic)
     V = np.zeros(world.Ns)
-    i = 0
-    while True:
-        V_prev = copy.deepcopy(V)
-        V_new = value_update(world, V, Pol, i, discount)
-        error = np.max(np.abs(V_new - V_prev))
-        print('Iteration:{}, error={}'.format(i, error))
-        V = V_new
-        if error < eps_convergence:
-            print("value fully learned after %d iterations" % (i,))
-            print('Error:', error)
-            break
-        elif i > max_iters:
-            print("value finished without convergence after %d iterations" % (i,))
-            break
-        i += 1
 
+    def update(V, i):
+        return value_update(world, V, Pol, i, discount, layers)
+
+    V, certificate = run_sweeps(world, update, V, discount, eps_convergence, max_iters, acceleration, tolerance,
+                                exact=layers is not None)
+    V, = expand_states(world, V)
+    if return_certificate:
+        return V, certificate
     return V
 
 # def main():
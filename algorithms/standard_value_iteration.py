@@ -1,56 +1,85 @@
-import copy
 import pickle
 
 import numpy as np
 from matplotlib.style.core import available
 
+from algorithms.prioritized_sweeping import prioritized_sweeping
+from algorithms.stopping import acyclic_layers, run_sweeps
+from algorithms.transition_tensor import compile_world, expand_states, q_values
 from environments.autonomous_car import AutonomousCarNavigation
 from environments.cliffwalker import GridWorld
 from environments.simple_env import SimpleEnv
 
 
-def value_update(world, V, Pol, i, discount):
-    V_ = copy.deepcopy(V)
-    for s in world.states():
-        q_values = []
-        available_actions = world.actions(s)
-        for a in available_actions:
-            Q = 0
-            for t in world.transitions(s)[a]:
-                Q += t.prob * (t.reward + discount * V_[t.state.id])
-            q_values.append(Q)
+def value_update(world, V, Pol, i, discount, layers=None):
+    mdp = compile_world(world)
+    V = V.copy()
+    # a backward induction sweep backs up the layers in turn, each from the values of the layers before it
+    for ids in [mdp.state_ids] if layers is None else layers:
+        Q = q_values(mdp, V, discount, ids)
+        Pol[ids] = np.argmax(Q, axis=1)
+        V[ids] = Q[np.arange(len(ids)), Pol[ids]]
 
-        max_idx = np.argmax(q_values)
-        Pol[s.id] = available_actions[max_idx]
-        V[s.id] = q_values[max_idx]
+    return V, Pol
+
+
+def value_iteration(world, max_iters=1e3, eps_convergence=1e-3, acceleration=None, tolerance=None,
+                    return_certificate=False, detect_acyclic=True):
+    """
+    Value iteration. With a tolerance, the run stops as soon as the certified bounds of the last sweep
+    (stopping.certify) pin every value within tolerance and returns their midpoint; eps_convergence is then unused.
+    Acyclic worlds (transition_tensor.topological_layers) are solved exactly by a single backward induction sweep
+    unless detect_acyclic is False.
+
+    Returns:
+    tuple: (V, Pol), plus the certificate of the last sweep (see stopping.certify) if return_certificate.
+    """
+    world = compile_world(world)
+    layers = acyclic_layers(world, detect_acyclic)
+    V = np.zeros(world.Ns)
+    Pol = np.zeros_like(V, dtype=int)
+    DISCOUNT = 0.95
+
+    def update(V, i):
+        return value_update(world, V, Pol, i, DISCOUNT, layers)[0]
 
+    V, certificate = run_sweeps(world, update, V, DISCOUNT, eps_convergence, max_iters, acceleration, tolerance,
+                                exact=layers is not None)
+    V, Pol = expand_states(world, V, Pol)
+    if return_certificate:
+        return V, Pol, certificate
     return V, Pol
 
 
+def prioritized_value_iteration(world, max_iters=1e3, eps_convergence=1e-3, batch_size=1):
+    """
+    Value iteration driven by prioritized sweeping: only states whose successors changed by more than
+    eps_convergence are backed up again, largest change first.
 
+    Parameters:
+    world: The environment, or its compiled TransitionTensor.
+    max_iters (int, optional): Budget in sweep equivalents (max_iters * number of states backups). Defaults to 1e3.
+    eps_convergence (float, optional): Threshold on the pending change of a state. Defaults to 1e-3.
+    batch_size (int, optional): States backed up together. Defaults to 1.
 
-def value_iteration(world, max_iters=1e3, eps_convergence=1e-3):
+    Returns:
+    tuple: (V, Pol) as returned by value_iteration.
+    """
+    world = compile_world(world)
     V = np.zeros(world.Ns)
     Pol = np.zeros_like(V, dtype=int)
     DISCOUNT = 0.95
 
-    i = 0
-    while True:
-        V_prev = copy.deepcopy(V)
-        V_new, Pol = value_update(world, V, Pol, i, DISCOUNT)
-        error = np.max(np.abs(V_new - V_prev))
-        print('Iteration:{}, error={}'.format(i, error))
-        V = V_new
-        if error < eps_convergence:
-            print("value fully learned after %d iterations" % (i,))
-            print('Error:', error)
-            break
-        elif i > max_iters:
-            print("value finished without convergence after %d iterations" % (i,))
-            break
-        i += 1
+    def backup(ids):
+        Q = q_values(world, V, DISCOUNT, ids)
+        Pol[ids] = np.argmax(Q, axis=1)
+        return Q[np.arange(len(ids)), Pol[ids]]
 
-    return V, Pol
+    backups = prioritized_sweeping(world, V, backup, DISCOUNT, threshold=eps_convergence,
+                                   max_backups=int(max_iters * len(world.state_ids)), batch_size=batch_size)
+    print("value learned with %d backups (%.1f sweep equivalents)" % (backups, backups / len(world.state_ids)))
+
+    return expand_states(world, V, Pol)
 
 
 def main():
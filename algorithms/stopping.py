@@ -0,0 +1,129 @@
+import numpy as np
+
+from algorithms.acceleration import make_accelerator
+from algorithms.transition_tensor import expand_states, topological_layers
+
+# IMPLEMENTATION OF THE CERTIFIED STOPPING RULE AND SWEEP LOOP SHARED BY THE VALUE ITERATION AND POLICY EVALUATION
+# DRIVERS
+
+
+def span(x):
+    """ The span seminorm max(x) - min(x). """
+    return np.max(x) - np.min(x)
+
+
+def certify(mdp, V, V_new, discount):
+    """
+    Bounds on the fixed point V* of a sweep from the change d = V_new - V of one sweep (MacQueen's bounds).
+
+    The sweeps (expected or CVaR backups, max over actions or a fixed policy, Jacobi or Gauss-Seidel) are monotone
+    and move by discount * c when every value moves by c, which gives, entrywise,
+        V_new + discount / (1 - discount) * min(d) <= V* <= V_new + discount / (1 - discount) * max(d),
+    over the enumerated states and alpha atoms. The states the world does not enumerate keep their values, so 0 is
+    included in the range of d and their bounds are their values (NaN for the unreachable states of a pruned world,
+    see transition_tensor.prune_unreachable). The width of the bounds is
+    discount / (1 - discount) * span(d), and the midpoint of the bounds is within half of it from V*.
+
+    Parameters:
+    mdp (TransitionTensor): The compiled world.
+    V (np.array): The values before the sweep, shape (Ns,) or (Ny, Ns).
+    V_new (np.array): The values after the sweep.
+    discount (float): The discount factor.
+
+    Returns:
+    dict: lower and upper (the bounds, shaped like V), midpoint (their midpoint), residual (max|d|), span (of d and
+        0), error_bound (the largest distance of midpoint to V*) and value_error_bound (that of V_new).
+    """
+    d = (V_new - V)[..., mdp.state_ids]
+    scale = discount / (1 - discount)
+    low, high = min(np.min(d), 0.), max(np.max(d), 0.)
+    lower, upper = np.array(V_new, dtype=float), np.array(V_new, dtype=float)
+    lower[..., mdp.state_ids] += scale * low
+    upper[..., mdp.state_ids] += scale * high
+    lower, upper = expand_states(mdp, lower, upper)
+    return {'lower': lower, 'upper': upper, 'midpoint': (lower + upper) / 2, 'residual': float(np.max(np.abs(d))),
+            'span': float(high - low), 'error_bound': float(scale * (high - low) / 2),
+            'value_error_bound': float(scale * max(high, -low))}
+
+
+def should_stop(certificate, eps_convergence, tolerance=None):
+    """
+    The stopping rule of the drivers: the residual below eps_convergence or, with a tolerance, the certified error
+    bound of the midpoint below tolerance.
+    """
+    if tolerance is None:
+        return certificate['residual'] < eps_convergence
+    return certificate['error_bound'] <= tolerance
+
+
+def report_certificate(certificate, V, iterations, tolerance=None):
+    """
+    Records the iteration count in the certificate of the last sweep and prints its error bound.
+
+    Returns:
+    np.array: The values the driver returns: the midpoint of the bounds with a tolerance, V (the last sweep) otherwise.
+    """
+    certificate['iterations'] = iterations
+    if tolerance is None:
+        print('Certified error bound: {} (span {})'.format(certificate['value_error_bound'], certificate['span']))
+        return V
+    print('Certified error bound: {} (span {}), midpoint of the bounds returned'.format(certificate['error_bound'],
+                                                                                         certificate['span']))
+    return certificate['midpoint']
+
+
+def acyclic_layers(mdp, detect_acyclic=True):
+    """
+    The layers of an acyclic world (transition_tensor.topological_layers), which a single backward induction sweep
+    solves exactly; None if the world has cycles or detect_acyclic is False.
+    """
+    layers = topological_layers(mdp) if detect_acyclic else None
+    if layers is not None:
+        print('Acyclic transition graph: backward induction over %d layers' % len(layers))
+    return layers
+
+
+def run_sweeps(mdp, sweep, V, discount, eps_convergence=1e-3, max_iters=1e3, acceleration=None, tolerance=None,
+               exact=False):
+    """
+    The sweep loop of the drivers: V <- sweep(V, i) until the stopping rule (should_stop) holds or max_iters is
+    passed. Every sweep is certified (certify) and the accelerator extrapolates between sweeps.
+
+    Parameters:
+    mdp (TransitionTensor): The compiled world.
+    sweep (callable): sweep(V, i) returns the values after sweep i, a new array or V updated in place.
+    V (np.array): The initial values.
+    discount (float): The discount factor.
+    eps_convergence (float, optional): Threshold on the residual of a sweep. Defaults to 1e-3.
+    max_iters (int, optional): Largest number of sweeps. Defaults to 1e3.
+    acceleration (str | Accelerator, optional): See acceleration.make_accelerator. Defaults to None (plain sweeps).
+    tolerance (float, optional): Requested accuracy, see should_stop. Defaults to None, the residual rule.
+    exact (bool, optional): The sweep gives the exact values (backward induction over the layers of an acyclic world), it then
+        certifies its own values. Defaults to False.
+
+    Returns:
+    tuple: (V, certificate), V as returned by report_certificate and the certificate of the last sweep.
+    """
+    accelerator = make_accelerator(acceleration)
+    i = 0
+    while True:
+        V_prev = np.array(V, dtype=float)
+        V_new = sweep(V, i)
+        error = np.max(np.abs(V_new - V_prev))
+        certificate = certify(mdp, V_new if exact else V_prev, V_new, discount)
+        print('Iteration:{}, error={}, span={}'.format(i, error, certificate['span']))
+        V = V_new
+        if should_stop(certificate, eps_convergence, tolerance):
+            print("value fully learned after %d iterations" % (i,))
+            print('Error:', error)
+            break
+        elif i > max_iters:
+            print("value finished without convergence after %d iterations" % (i,))
+            break
+        V = accelerator.step(V_prev, V_new, error)
+        i += 1
+
+    V = report_certificate(certificate, V, i, tolerance)
+    if accelerator.method is not None:
+        print(accelerator.report())
+    return V, certificate
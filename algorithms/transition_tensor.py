@@ -0,0 +1,484 @@
+import copy
+from collections import namedtuple
+
+import numpy as np
+
+# IMPLEMENTATION OF A COMPILED (CSR-STYLE) TRANSITION STRUCTURE SHARED BY ALL SOLVERS
+
+Transition = namedtuple('Transition', ['state', 'prob', 'reward'])
+
+
+class TransitionTensor:
+    """
+    One-time compilation of an environment into flat transition arrays.
+
+    Row r = s * Na + a of the structure holds the successors of action a in state s, stored in
+    next_id[indptr[r]:indptr[r + 1]] together with the matching prob and reward entries.
+    Only the states enumerated by world.states() get rows; every other state has no successors
+    and no available actions, exactly as the solvers treated them before.
+
+    The object exposes the same interface as the environments (Ns, ACTIONS, initial_state,
+    states(), actions(s), transitions(s), is_terminal(s), sample_transition(s, a)), so it can be
+    passed to any solver in place of the world it was compiled from.
+    """
+
+    def __init__(self, world):
+        self.world = world
+        self.Ns = world.Ns
+        self.ACTIONS = list(world.ACTIONS)
+        self.Na = len(self.ACTIONS)
+        self.initial_state = world.initial_state
+
+        states = list(world.states())
+        # original state objects by id, for the enumerated states and every successor they reach
+        self.state_objects = {s.id: s for s in states}
+        self.state_ids = np.array([s.id for s in states], dtype=np.int64)
+        self.action_mask = np.zeros((self.Ns, self.Na), dtype=bool)
+
+        # rows are filled in the order the world enumerates its states, then laid out by row index
+        rows = {}
+        for s in states:
+            transitions = world.transitions(s)
+            self.action_mask[s.id, world.actions(s)] = True
+            for a in self.ACTIONS:
+                rows[s.id * self.Na + a] = transitions[a]
+                for trans in transitions[a]:
+                    self.state_objects.setdefault(trans.state.id, trans.state)
+
+        counts = np.zeros(self.Ns * self.Na, dtype=np.int64)
+        next_ids, probs, rewards = [], [], []
+        for r in sorted(rows):
+            counts[r] = len(rows[r])
+            for trans in rows[r]:
+                next_ids.append(trans.state.id)
+                probs.append(trans.prob)
+                rewards.append(trans.reward)
+
+        self.indptr = np.concatenate(([0], np.cumsum(counts)))
+        self.next_id = np.array(next_ids, dtype=np.int64)
+        self.prob = np.array(probs, dtype=float)
+        self.reward = np.array(rewards, dtype=float)
+        self.terminal_mask = np.zeros(self.Ns, dtype=bool)
+        if hasattr(world, 'is_terminal'):
+            for s_id, state in self.state_objects.items():
+                self.terminal_mask[s_id] = world.is_terminal(state)
+        # the world's goal states if it declares them, its terminal states otherwise
+        if hasattr(world, 'goal_states'):
+            self.goal_ids = np.array(sorted(s.id for s in world.goal_states), dtype=np.int64)
+        else:
+            self.goal_ids = np.flatnonzero(self.terminal_mask)
+        # boolean mask of the states reachable from initial_state once pruned (see prune_unreachable), None otherwise
+        self.reachable = None
+        # the representative of every state's class once lumped (see lump_states), None otherwise
+        self.representative = None
+        self._padded = None
+        self._predecessors = None
+
+    def row(self, s_id, a):
+        """
+        Returns the successors of action a in state s_id as views into the flat arrays.
+
+        Returns:
+        tuple: (next_ids, probabilities, rewards) numpy arrays.
+        """
+        r = s_id * self.Na + a
+        start, end = self.indptr[r], self.indptr[r + 1]
+        return self.next_id[start:end], self.prob[start:end], self.reward[start:end]
+
+    def padded(self):
+        """
+        Dense (Ns, Na, K) view of the transitions, K being the largest number of successors of any row.
+        Padding entries point to state 0 with probability and reward 0, so they drop out of any expectation.
+
+        Returns:
+        tuple: (next_ids, probabilities, rewards) numpy arrays of shape (Ns, Na, K).
+        """
+        if self._padded is None:
+            counts = np.diff(self.indptr)
+            K = max(int(counts.max(initial=0)), 1)
+            rows = np.repeat(np.arange(self.Ns * self.Na), counts)
+            cols = np.arange(len(self.next_id)) - np.repeat(self.indptr[:-1], counts)
+            next_ids = np.zeros((self.Ns * self.Na, K), dtype=np.int64)
+            probs = np.zeros((self.Ns * self.Na, K))
+            rewards = np.zeros((self.Ns * self.Na, K))
+            next_ids[rows, cols] = self.next_id
+            probs[rows, cols] = self.prob
+            rewards[rows, cols] = self.reward
+            shape = (self.Ns, self.Na, K)
+            self._padded = next_ids.reshape(shape), probs.reshape(shape), rewards.reshape(shape)
+        return self._padded
+
+    def predecessors(self):
+        """
+        Reverse adjacency of the transition graph: the states with an available action reaching s with positive
+        probability are pred_ids[pred_indptr[s]:pred_indptr[s + 1]].
+
+        Returns:
+        tuple: (pred_indptr, pred_ids) numpy arrays.
+        """
+        if self._predecessors is None:
+            rows = np.repeat(np.arange(self.Ns * self.Na), np.diff(self.indptr))
+            keep = self.action_mask.ravel()[rows] & (self.prob > 0)
+            edges = np.unique(np.stack((self.next_id[keep], rows[keep] // self.Na), axis=1), axis=0)
+            counts = np.bincount(edges[:, 0], minlength=self.Ns)
+            self._predecessors = np.concatenate(([0], np.cumsum(counts))), edges[:, 1]
+        return self._predecessors
+
+    def states(self):
+        """ iterator over the states the world enumerates """
+        for s_id in self.state_ids:
+            yield self.state_objects[s_id]
+
+    def actions(self, s):
+        return [a for a in self.ACTIONS if self.action_mask[s.id, a]]
+
+    def transitions(self, s):
+        """ Rebuilds the per-action Transition lists, for code that still expects the environment format. """
+        all_transitions = []
+        for a in self.ACTIONS:
+            next_ids, probs, rewards = self.row(s.id, a)
+            all_transitions.append([Transition(self.state_objects[n], float(p), float(r))
+                                    for n, p, r in zip(next_ids, probs, rewards)])
+        return all_transitions
+
+    def is_terminal(self, s):
+        return bool(self.terminal_mask[s.id])
+
+    def sample_transition(self, s, a):
+        next_ids, probs, rewards = self.row(s.id, a)
+        idx = np.random.choice(len(next_ids), p=probs)
+        return Transition(self.state_objects[next_ids[idx]], float(probs[idx]), float(rewards[idx]))
+
+
+def compile_world(world, reachable_only=False, lump=False):
+    """
+    Compiles the world into a TransitionTensor, leaving already compiled worlds untouched.
+
+    Parameters:
+    world: An environment (GridWorld, AutonomousCarNavigation, SimpleEnv) or a TransitionTensor.
+    reachable_only (bool, optional): Prune the states unreachable from the initial state, see prune_unreachable.
+        Defaults to False.
+    lump (bool, optional): Solve one representative per class of equivalent states, see lump_states.
+        Defaults to False.
+
+    Returns:
+    TransitionTensor: The compiled transition structure.
+    """
+    if not isinstance(world, TransitionTensor):
+        world = TransitionTensor(world)
+    if reachable_only and world.reachable is None:
+        world = prune_unreachable(world)
+    if lump and world.representative is None:
+        world = lump_states(world)
+    return world
+
+
+def transition_edges(mdp):
+    """
+    The edges of the transition graph: one (state, successor, reward) entry per successor with positive probability
+    of every available action.
+
+    Returns:
+    tuple: (sources, targets, rewards) numpy arrays.
+    """
+    rows = np.repeat(np.arange(mdp.Ns * mdp.Na), np.diff(mdp.indptr))
+    keep = mdp.action_mask.ravel()[rows] & (mdp.prob > 0)
+    return rows[keep] // mdp.Na, mdp.next_id[keep], mdp.reward[keep]
+
+
+def reachable_states(mdp, start_ids=None):
+    """
+    Breadth-first search from the start states over the transitions of the available actions with positive
+    probability.
+
+    Parameters:
+    mdp (TransitionTensor): The compiled world.
+    start_ids (array, optional): The start states. Defaults to the initial state.
+
+    Returns:
+    np.array: Boolean mask of shape (Ns,), True for the states reachable from a start state (themselves included).
+    """
+    sources, targets, _ = transition_edges(mdp)
+    order = np.argsort(sources, kind='stable')
+    sources, targets = sources[order], targets[order]
+    succ_indptr = np.concatenate(([0], np.cumsum(np.bincount(sources, minlength=mdp.Ns))))
+
+    reachable = np.zeros(mdp.Ns, dtype=bool)
+    frontier = np.unique(np.atleast_1d([mdp.initial_state.id] if start_ids is None else start_ids))
+    reachable[frontier] = True
+    while len(frontier):
+        reached = np.concatenate([targets[succ_indptr[s]:succ_indptr[s + 1]] for s in frontier])
+        frontier = np.unique(reached[~reachable[reached]])
+        reachable[frontier] = True
+    return reachable
+
+
+def prune_unreachable(mdp, start_ids=None):
+    """
+    A view of the compiled world restricted to the states reachable from the initial state (see reachable_states).
+    Only those states are enumerated, so every sweep, prioritized backup and LP solve skips the others; value and
+    policy arrays keep their (..., Ns) layout, so that state ids still index them, and the drivers mark the
+    unreachable entries in their outputs (see mark_unreachable). The reachable set is closed under the transitions,
+    so the values of the reachable states are those of the full world.
+
+    Parameters:
+    mdp (TransitionTensor): The compiled world.
+    start_ids (array, optional): The start states. Defaults to the initial state.
+
+    Returns:
+    TransitionTensor: The pruned world, with its reachable mask set.
+    """
+    reachable = reachable_states(mdp, start_ids)
+    pruned = copy.copy(mdp)
+    pruned.state_ids = mdp.state_ids[reachable[mdp.state_ids]]
+    pruned.reachable = reachable
+    pruned._predecessors = None
+    print('Reachable states: {} of {} enumerated'.format(len(pruned.state_ids), len(mdp.state_ids)))
+    return pruned
+
+
+def lump_states(mdp, policy=None):
+    """
+    A view of the compiled world that backs up one representative per class of equivalent states.
+
+    Two enumerated states are equivalent when they have the same available actions and, for every action, the same
+    distribution of (reward, class of the successor): the coarsest such partition is found by refinement, starting
+    from a single class and splitting on these signatures until they are stable. Equivalent states have the same
+    expected and CVaR values for every alpha, and the same greedy actions, so solving the representatives is
+    lossless. The view enumerates the representatives only and points every transition at the representative of
+    its successor; the drivers copy the results back to the other states (see expand_states). The states the world
+    does not enumerate keep a class of their own.
+
+    Parameters:
+    mdp (TransitionTensor): The compiled world.
+    policy (np.array, optional): Action weights of shape (Ns, Na) of a policy to evaluate on the view, which then
+        only lumps states where the policy agrees. Defaults to None.
+
+    Returns:
+    TransitionTensor: The lumped world, with its representative array set, or mdp itself if no states are
+        equivalent.
+    """
+    states, actions = np.divmod(np.repeat(np.arange(mdp.Ns * mdp.Na), np.diff(mdp.indptr)), mdp.Na)
+    enumerated = np.zeros(mdp.Ns, dtype=bool)
+    enumerated[mdp.state_ids] = True
+    base = {s: (mdp.action_mask[s].tobytes(), bool(mdp.terminal_mask[s]),
+                None if policy is None else np.round(policy[s], 12).tobytes()) for s in mdp.state_ids}
+
+    # labels of the states the world does not enumerate are their ids, the classes are numbered from Ns on
+    labels = np.arange(mdp.Ns)
+    labels[mdp.state_ids] = mdp.Ns
+    n_classes = 1
+    while True:
+        masses = {}
+        for s, a, n, p, r in zip(states, actions, labels[mdp.next_id], mdp.prob, mdp.reward):
+            if enumerated[s] and mdp.action_mask[s, a]:
+                key = (s, a, n, r)
+                masses[key] = masses.get(key, 0.) + p
+        signatures = {s: [] for s in mdp.state_ids}
+        for (s, a, n, r), p in masses.items():
+            signatures[s].append((a, n, r, round(p, 12)))
+        classes = {}
+        new_labels = labels.copy()
+        for s in mdp.state_ids:
+            signature = (labels[s], base[s], tuple(sorted(signatures[s])))
+            new_labels[s] = mdp.Ns + classes.setdefault(signature, len(classes))
+        labels = new_labels
+        if len(classes) == n_classes:
+            break
+        n_classes = len(classes)
+
+    if n_classes == len(mdp.state_ids):
+        print('Lumped states: no equivalent states among {} enumerated states'.format(len(mdp.state_ids)))
+        return mdp
+
+    representative = np.arange(mdp.Ns)
+    first = {}
+    for s in mdp.state_ids:
+        representative[s] = first.setdefault(labels[s], s)
+
+    lumped = copy.copy(mdp)
+    lumped.next_id = representative[mdp.next_id]
+    lumped.state_ids = mdp.state_ids[representative[mdp.state_ids] == mdp.state_ids]
+    lumped.representative = representative
+    lumped._padded = None
+    lumped._predecessors = None
+    print('Lumped states: {} classes for {} enumerated states'.format(len(lumped.state_ids), len(mdp.state_ids)))
+    return lumped
+
+
+def check_lumped_policy(mdp, policy):
+    """
+    Raises a ValueError if the policy, action weights of shape (Ns, Na), acts differently in states that mdp lumps
+    together (see lump_states): the view only evaluates the representatives.
+    """
+    if mdp.representative is not None and not np.allclose(policy, policy[..., mdp.representative, :]):
+        raise ValueError("The policy acts differently in lumped states, lump with lump_states(world, policy)")
+
+
+def expand_states(mdp, *arrays):
+    """
+    Full-size outputs of a reduced world, for value or policy arrays indexed by state along the last axis: every
+    lumped state takes the entries of its representative (see lump_states), then the unreachable states are marked
+    (see mark_unreachable).
+
+    Returns:
+    tuple: The expanded copies, in the order given.
+    """
+    if mdp.representative is not None:
+        arrays = tuple(np.asarray(array)[..., mdp.representative] for array in arrays)
+    return mark_unreachable(mdp, *arrays)
+
+
+def mark_unreachable(mdp, *arrays):
+    """
+    Marks the unreachable states of a pruned world in value or policy arrays indexed by state along the last axis:
+    NaN in float arrays, -1 in integer arrays. Arrays of unpruned worlds are returned unchanged.
+
+    Returns:
+    tuple: The marked copies, in the order given.
+    """
+    if mdp.reachable is None:
+        return arrays
+    marked = []
+    for array in arrays:
+        array = np.array(array)
+        array[..., ~mdp.reachable] = np.nan if np.issubdtype(array.dtype, np.floating) else -1
+        marked.append(array)
+    return tuple(marked)
+
+
+def restrict_actions(mdp, action_mask):
+    """
+    A view of the compiled world in which only the actions of action_mask are available. The transition arrays are
+    shared with mdp; solvers skip the masked out actions (and report them as unavailable).
+
+    Parameters:
+    mdp (TransitionTensor): The compiled world.
+    action_mask (np.array): Boolean mask of shape (Ns, Na), combined with the world's own action mask.
+
+    Returns:
+    TransitionTensor: The restricted world.
+    """
+    restricted = copy.copy(mdp)
+    restricted.action_mask = mdp.action_mask & action_mask
+    restricted._predecessors = None
+    return restricted
+
+
+def q_values(mdp, V, discount, state_ids=None):
+    """
+    Computes every Q-value with a single gather-multiply-reduce over the padded transition arrays.
+
+    Parameters:
+    mdp (TransitionTensor): The compiled world.
+    V (np.array): The current value function, shape (Ns,).
+    discount (float): The discount factor for future rewards.
+    state_ids (np.array, optional): Only compute the Q-values of these states. Defaults to all states.
+
+    Returns:
+    np.array: Q-values of shape (Ns, Na) (or (len(state_ids), Na)), -inf for unavailable actions.
+    """
+    next_ids, probs, rewards = mdp.padded()
+    action_mask = mdp.action_mask
+    if state_ids is not None:
+        next_ids, probs, rewards, action_mask = next_ids[state_ids], probs[state_ids], rewards[state_ids], \
+            action_mask[state_ids]
+    Q = (probs * (rewards + discount * V[next_ids])).sum(axis=-1)
+    return np.where(action_mask, Q, -np.inf)
+
+
+def policy_mixture(policy, Q):
+    """
+    Values of a (possibly stochastic) policy from its Q-values.
+
+    Parameters:
+    policy (np.array): Action weights of the states, shape (S, Na).
+    Q (np.array): Their Q-values, shape (S, Na) or (S, Na, Ny), -inf for unavailable actions.
+
+    Returns:
+    np.array: The values, shape (S,) or (S, Ny).
+    """
+    # unavailable actions carry no probability mass, zero them instead of letting -inf poison the sum
+    Q = np.where(np.isfinite(Q), Q, 0)
+    return np.einsum('sa,sa...->s...', policy, Q)
+
+
+def goal_distances(mdp):
+    """
+    Breadth-first search from the goal states over the reversed transition graph.
+
+    Parameters:
+    mdp (TransitionTensor): The compiled world.
+
+    Returns:
+    np.array: The least number of steps from every state to a goal state, -1 where no goal is reachable.
+    """
+    pred_indptr, pred_ids = mdp.predecessors()
+    distances = np.full(mdp.Ns, -1, dtype=np.int64)
+    frontier = mdp.goal_ids
+    distances[frontier] = 0
+    depth = 0
+    while len(frontier):
+        depth += 1
+        reached = np.concatenate([pred_ids[pred_indptr[s]:pred_indptr[s + 1]] for s in frontier])
+        frontier = np.unique(reached[distances[reached] < 0])
+        distances[frontier] = depth
+    return distances
+
+
+def topological_layers(mdp):
+    """
+    Layers of the enumerated states of an acyclic world, successors first: every state only reaches states of
+    earlier layers (or states the world does not enumerate), so one backup per state, layer by layer, gives the
+    exact values (backward induction), and the states of a layer can be backed up together.
+
+    Zero-reward self-loops of terminal states are ignored, they leave the zero value of an absorbing state unchanged.
+
+    Parameters:
+    mdp (TransitionTensor): The compiled world.
+
+    Returns:
+    list: The layers as arrays of state ids, or None if the transition graph has a cycle.
+    """
+    sources, targets, rewards = transition_edges(mdp)
+    enumerated = np.zeros(mdp.Ns, dtype=bool)
+    enumerated[mdp.state_ids] = True
+    absorbing = (sources == targets) & mdp.terminal_mask[sources] & (rewards == 0)
+    keep = enumerated[sources] & enumerated[targets] & ~absorbing
+    edges = np.unique(np.stack((targets[keep], sources[keep]), axis=1), axis=0)
+    successors_left = np.bincount(edges[:, 1], minlength=mdp.Ns)
+    pred_indptr = np.concatenate(([0], np.cumsum(np.bincount(edges[:, 0], minlength=mdp.Ns))))
+
+    layers = []
+    frontier = mdp.state_ids[successors_left[mdp.state_ids] == 0]
+    while len(frontier):
+        layers.append(frontier)
+        preds = np.concatenate([edges[pred_indptr[s]:pred_indptr[s + 1], 1] for s in frontier])
+        np.subtract.at(successors_left, preds, 1)
+        frontier = np.unique(preds[successors_left[preds] == 0])
+    if sum(len(layer) for layer in layers) < len(mdp.state_ids):
+        return None
+    return layers
+
+
+def sweep_order(mdp, order=None):
+    """
+    The order in which an in-place sweep visits the states.
+
+    Parameters:
+    mdp (TransitionTensor): The compiled world.
+    order (str | array, optional): 'natural' (None) for the order the world enumerates its states, 'goal_bfs' for
+        increasing distance to the goal states (states that cannot reach a goal last), or an explicit array of ids.
+
+    Returns:
+    np.array: The state ids in sweep order.
+    """
+    if order is None or isinstance(order, str) and order == 'natural':
+        return mdp.state_ids
+    if isinstance(order, str) and order == 'goal_bfs':
+        distances = goal_distances(mdp)[mdp.state_ids]
+        distances = np.where(distances < 0, np.iinfo(np.int64).max, distances)
+        return mdp.state_ids[np.argsort(distances, kind='stable')]
+    if isinstance(order, str):
+        raise ValueError("Unknown sweep order '%s', expected 'natural', 'goal_bfs' or an array of state ids" % order)
+    return np.asarray(order, dtype=np.int64)
@@ -34,4 +34,15 @@ class FixedPolicy(Policy):
             self.policy[s.id, policy[s.id]] = 1
 
     def get_action(self, state):
-        return self.policy[state.id].argmax()
\ No newline at end of file
+        return self.policy[state.id].argmax()
+
+class AlphaFixedPolicy(Policy):
+    """ A deterministic policy per alpha atom, e.g. the (Ny, Ns) Pol of cvar_value_iteration: one FixedPolicy per atom. """
+    def __init__(self, env, policy):
+        super().__init__(env)
+        self.policies = [FixedPolicy(env, alpha_policy) for alpha_policy in policy]
+        # (Ny, Ns, Na) one-hot action weights
+        self.policy = np.array([alpha_policy.policy for alpha_policy in self.policies])
+
+    def get_action(self, state, alpha_idx=-1):
+        return self.policies[alpha_idx].get_action(state)
@@ -4,8 +4,9 @@ import random
 
 import numpy as np
 import pandas as pd
-from joblib import Parallel, delayed
 
+from algorithms.cvar_estimation import StreamingCvar
+from algorithms.rollouts import stream_returns
 from algorithms.utils import FixedPolicy
 from environments.autonomous_car import AutonomousCarNavigation
 import matplotlib.pyplot as plt
@@ -16,25 +17,13 @@ EXP_IDX = 0
 DATA = {'cvar_exp_policy': [], 'cvar_cvar_policy': [], 'exp_exp_policy': [], 'exp_cvar_policy': [], 'std_exp_policy': [], 'std_cvar_policy': []}
 BUFFER = None
 
-def get_return(env, policy, gamma):
-    ret = 0
-    i = 0
-    state = env.initial_state
-    while not env.is_terminal(state):
-        action = policy.get_action(state)
-        t = env.sample_transition(state, action)
-        ret += gamma ** i * t.reward
-        i += 1
-        state = t.state
-    return ret
-
 def plot_distributions(r_cvar, r_exp, alpha, cvar_cvar_policy, cvar_exp_policy, exp_exp_policy, exp_cvar_policy):
     """
     Plots the distributions of returns for CVaR and Expected policies.
 
     Args:
-        r_cvar (np.ndarray): Array of returns for the CVaR policy.
-        r_exp (np.ndarray): Array of returns for the Expected policy.
+        r_cvar (np.ndarray): Sample of returns for the CVaR policy.
+        r_exp (np.ndarray): Sample of returns for the Expected policy.
         alpha (float): The alpha value used for CVaR calculation.
         cvar_cvar_policy (float): CVaR return for the CVaR policy.
         cvar_exp_policy (float): CVaR return for the Expected policy.
@@ -62,32 +51,45 @@ def seed_everything(param):
     os.environ["PYTHONHASHSEED"] = str(param)
 
 
+def stream_statistics(env, policy, alphas):
+    """
+    Streams the returns of NUM_TRAJECTORIES trajectories of a policy through StreamingCvar.
+
+    Returns:
+    tuple: The CVaR at each alpha, the mean and the standard deviation of the returns, and the first batch of returns
+        (a sample for the histograms).
+    """
+    # the exact tail covers every alpha below 1, so the CVaRs match the sorted returns
+    inner = [alpha for alpha in alphas if alpha < 1]
+    estimator = StreamingCvar(list(alphas) + [1], NUM_TRAJECTORIES, tail_alpha=max(inner, default=0))
+    sample = None
+    for returns in stream_returns(env, policy, GAMMA, NUM_TRAJECTORIES):
+        estimator.update(returns)
+        sample = returns if sample is None else sample
+    _, cvar = estimator.estimates()
+    return cvar[:-1], cvar[-1], estimator.std(), sample
+
+
 def run_experiment(env, alpha, CvarPolicy, StandardPolicy):
     seed_everything(42)
-    r_cvar = np.array(Parallel(n_jobs=-1, verbose=False)(delayed(get_return)(env, CvarPolicy, GAMMA) for _ in range(NUM_TRAJECTORIES)))
-    r_cvar.sort()
-    cvar_cvar_policy = float(np.mean(r_cvar[r_cvar <= np.quantile(r_cvar, alpha)]))
-    exp_cvar_policy = float(np.mean(r_cvar))
+    cvar, exp_cvar_policy, std_cvar_policy, r_cvar = stream_statistics(env, CvarPolicy, [alpha])
+    cvar_cvar_policy = float(cvar[0])
 
     seed_everything(42)
     global BUFFER, EXP_IDX
     if EXP_IDX == 0:
-        r_exp = np.array(Parallel(n_jobs=-1, verbose=False)(delayed(get_return)(env, StandardPolicy, GAMMA) for _ in range(NUM_TRAJECTORIES)))
-        r_exp.sort()
-        BUFFER = r_exp
-        EXP_IDX+=1
-    else:
-        r_exp = BUFFER
-
-    cvar_exp_policy = float(np.mean(r_exp[r_exp <= np.quantile(r_exp, alpha)]))
-    exp_exp_policy = float(np.mean(r_exp))
+        # the standard policy is the same for every alpha, its returns are streamed once for all of them
+        BUFFER = stream_statistics(env, StandardPolicy, DATA['alphas'])
+    cvar, exp_exp_policy, std_exp_policy, r_exp = BUFFER
+    cvar_exp_policy = float(cvar[EXP_IDX])
+    EXP_IDX += 1
 
     DATA['cvar_exp_policy'].append(cvar_exp_policy)
     DATA['cvar_cvar_policy'].append(cvar_cvar_policy)
-    DATA['exp_exp_policy'].append(exp_exp_policy)
-    DATA['exp_cvar_policy'].append(exp_cvar_policy)
-    DATA['std_exp_policy'].append(np.std(r_exp))
-    DATA['std_cvar_policy'].append(np.std(r_cvar))
+    DATA['exp_exp_policy'].append(float(exp_exp_policy))
+    DATA['exp_cvar_policy'].append(float(exp_cvar_policy))
+    DATA['std_exp_policy'].append(std_exp_policy)
+    DATA['std_cvar_policy'].append(std_cvar_policy)
 
     plot_distributions(r_cvar, r_exp, alpha, cvar_cvar_policy, cvar_exp_policy, exp_exp_policy, exp_cvar_policy)
 
@@ -1,16 +1,11 @@
-import numpy as np
+from algorithms.error_bound import get_error_bound, get_theta, log_grid
 
 gamma = 0.95
 epsilon = 1e-3
 Ny = 51
 
-def get_theta():
-    # Generate the discretization
-    atoms = np.concatenate(([0], np.logspace(-2, 0, Ny-1)))
-    # Calculate theta: the ratio between consecutive points (log-spacing)
-    theta = atoms[2] / atoms[1]  # Avoiding the zero element at index 0
-    return theta
 
-theta = get_theta()
-error_bound = (gamma / (1 - gamma)) * ((theta - 1) + epsilon)
-print(f"Error bound: {error_bound}")
\ No newline at end of file
+if __name__ == '__main__':
+    theta = get_theta(log_grid(Ny))
+    error_bound = get_error_bound(theta, epsilon, gamma)
+    print(f"Error bound: {error_bound}")